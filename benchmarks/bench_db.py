@@ -0,0 +1,74 @@
+"""Бенчмарк задержки вызовов Database: соединение на вызов против пула.
+
+Запуск: python benchmarks/bench_db.py [--iterations N] [--channels N]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import aiosqlite
+
+from common import load_bot, measure, report
+
+
+async def legacy_get_user_channels(db_path: str, user_id: int):
+    """Старое поведение: новое соединение (и поток) на каждый вызов"""
+    async with aiosqlite.connect(db_path) as conn:
+        async with conn.execute(
+            "SELECT id, channel_id, channel_name, is_admin FROM channels WHERE user_id = ?",
+            (user_id,)
+        ) as cursor:
+            return await cursor.fetchall()
+
+
+async def legacy_add_user(db_path: str, user_id: int):
+    """Старое поведение: соединение + коммит на каждый /start"""
+    async with aiosqlite.connect(db_path) as conn:
+        await conn.execute(
+            "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
+            (user_id, None)
+        )
+        await conn.commit()
+
+
+async def run(iterations: int, channels: int):
+    malik = load_bot()
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        db = malik.Database(db_path)
+        await db.init_db()
+        for i in range(channels):
+            await db.add_channel(1, -100_000 - i, f"Канал {i}")
+
+        report("legacy get_user_channels",
+               await measure(lambda: legacy_get_user_channels(db_path, 1), iterations))
+        report("pooled get_user_channels",
+               await measure(lambda: db.get_user_channels(1), iterations))
+
+        report("legacy add_user",
+               await measure(lambda: legacy_add_user(db_path, 1), iterations))
+        # Сейчас /start пишется пакетом через UserRegistry; здесь - пакет из одного пользователя
+        report("pooled save_users",
+               await measure(lambda: db.save_users([(1, None, time.time())], []), iterations))
+
+        # Параллельные чтения: пул читателей против соединения на вызов
+        async def legacy_burst():
+            await asyncio.gather(*(legacy_get_user_channels(db_path, 1) for _ in range(32)))
+
+        async def pooled_burst():
+            await asyncio.gather(*(db.get_user_channels(1) for _ in range(32)))
+
+        report("legacy 32x concurrent reads", await measure(legacy_burst, max(1, iterations // 10)))
+        report("pooled 32x concurrent reads", await measure(pooled_burst, max(1, iterations // 10)))
+
+        await db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--channels", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(run(args.iterations, args.channels))
@@ -0,0 +1,97 @@
+"""Бенчмарк запросов к каналам и черновикам до и после индексов миграции 5.
+
+Наполняет базу rows каналами и rows черновиками, меряет запросы на схеме
+без индексов (версия 4), затем применяет оставшиеся миграции и меряет снова.
+Запросы - сырой SQL методов Database без колонок поздних миграций, чтобы
+один и тот же запрос работал на обеих схемах.
+
+Запуск: python benchmarks/bench_indexes.py [--rows 1000000] [--iterations N]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+
+from common import load_bot, measure, report
+
+INDEX_MIGRATION = 5
+
+# Как в Database.get_user_channels
+CHANNELS_QUERY = "SELECT id, channel_id, channel_name, is_admin FROM channels WHERE user_id = ? ORDER BY id"
+# Как в Database.get_user_drafts, без media_count/buttons_count (миграция 7)
+DRAFTS_QUERY = """SELECT d.id, d.channel_id, substr(d.text, 1, 30), d.created_at, c.channel_name
+                  FROM drafts d
+                  LEFT JOIN channels c ON d.channel_id = c.channel_id AND d.user_id = c.user_id
+                  WHERE d.user_id = ?
+                  ORDER BY d.created_at DESC, d.id DESC LIMIT 8"""
+COUNT_QUERY = "SELECT COUNT(*) FROM drafts WHERE user_id = ?"
+
+
+def populate(db_path: str, rows: int, users: int):
+    """Быстрое наполнение синхронным sqlite3"""
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        "INSERT INTO users (user_id) VALUES (?)",
+        ((user_id,) for user_id in range(1, users + 1))
+    )
+    conn.executemany(
+        "INSERT INTO channels (user_id, channel_id, channel_name) VALUES (?, ?, ?)",
+        ((i % users + 1, -1_000_000_000 - i, f"Канал {i}") for i in range(rows))
+    )
+    conn.executemany(
+        "INSERT INTO drafts (user_id, channel_id, text, media, buttons) VALUES (?, ?, ?, '[]', '[]')",
+        ((i % users + 1, -1_000_000_000 - i, f"Черновик {i}") for i in range(rows))
+    )
+    conn.commit()
+    conn.close()
+
+
+async def run_queries(db, users: int, iterations: int, label: str):
+    rng = random.Random(42)
+
+    def query(sql: str):
+        async def run_query():
+            async with db._read() as conn:
+                async with conn.execute(sql, (rng.randint(1, users),)) as cursor:
+                    await cursor.fetchall()
+        return run_query
+
+    report(f"{label} get_user_channels", await measure(query(CHANNELS_QUERY), iterations))
+    report(f"{label} get_user_drafts", await measure(query(DRAFTS_QUERY), iterations))
+    report(f"{label} count drafts", await measure(query(COUNT_QUERY), iterations))
+
+
+async def run(rows: int, users: int, iterations: int):
+    malik = load_bot()
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        # Потоки aiosqlite не демоны: без close() процесс не завершится после ошибки
+        db = malik.Database(db_path)
+        await db.open()
+        try:
+            await db.migrate(target=INDEX_MIGRATION - 1)
+        finally:
+            await db.close()
+
+        print(f"Наполнение: {rows} каналов и {rows} черновиков, {users} пользователей...")
+        populate(db_path, rows, users)
+
+        db = malik.Database(db_path)
+        await db.open()
+        try:
+            await run_queries(db, users, iterations, "before")
+            await db.migrate()
+            await run_queries(db, users, iterations, "after ")
+        finally:
+            await db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(run(args.rows, args.users, args.iterations))
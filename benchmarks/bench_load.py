@@ -0,0 +1,268 @@
+"""Нагрузочный тест бота против фейкового Bot API.
+
+Бот целиком (диспетчер, хендлеры, FSM-хранилище, БД) работает в этом
+процессе, а запросы к Telegram уходят в FakeBotAPI с настраиваемой
+задержкой и долей ответов 429. Сценарии:
+
+- fsm: пользователи одновременно проходят PostCreation до сохранения черновика;
+- album: пользователи присылают альбом из нескольких фото;
+- drafts: просмотр списка черновиков и одного черновика;
+- broadcast: рассылка на --broadcast-users получателей.
+
+Для каждого сценария печатаются пропускная способность, p50/p99 задержки
+обработки апдейта по шагам и память процесса.
+
+Запуск: python benchmarks/bench_load.py [--users 2000] [--broadcast-users 100000]
+        [--latency 0.05] [--flood-rate 0.001]
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import resource
+import sqlite3
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from common import load_bot, percentile, report
+from fake_api import FakeBotAPI
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+
+def user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+
+
+def message_update(user_id: int, text: str = None, photo: str = None, media_group_id: str = None) -> dict:
+    message = {
+        "message_id": next(message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": user(user_id),
+    }
+    if text is not None:
+        message["text"] = text
+    if photo is not None:
+        message["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 1280, "height": 720}]
+    if media_group_id is not None:
+        message["media_group_id"] = media_group_id
+    return {"update_id": next(update_ids), "message": message}
+
+
+def callback_update(user_id: int, data: str) -> dict:
+    return {
+        "update_id": next(update_ids),
+        "callback_query": {
+            "id": str(next(update_ids)),
+            "from": user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+def memory() -> str:
+    """Текущий и пиковый RSS процесса"""
+    with open("/proc/self/statm") as statm:
+        rss = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return f"rss={rss:.0f}MB peak={peak:.0f}MB"
+
+
+class Scenario:
+    """Сбор задержек по шагам и итог сценария"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.samples = defaultdict(list)
+        self.updates = 0
+        self.errors = Counter()
+        self.started = time.perf_counter()
+
+    async def feed(self, malik, step: str, update: dict):
+        started = time.perf_counter()
+        try:
+            await malik.dp.feed_raw_update(malik.bot, update)
+        except Exception as e:
+            # Например, 429 на ответ пользователю: шаг считается, ошибка тоже
+            self.errors[type(e).__name__] += 1
+        self.samples[step].append((time.perf_counter() - started) * 1000)
+        self.updates += 1
+
+    def finish(self):
+        elapsed = time.perf_counter() - self.started
+        print(f"\n== {self.name}: {self.updates} updates in {elapsed:.2f}s "
+              f"({self.updates / elapsed:.0f} upd/s), {memory()}")
+        if self.errors:
+            print(f"  errors: {dict(self.errors)}")
+        for step, samples in self.samples.items():
+            report(f"  {step}", samples)
+        everything = [sample for samples in self.samples.values() for sample in samples]
+        if everything:
+            print(f"  {'all updates':<38} p50={percentile(everything, 50):8.3f}ms "
+                  f"p99={percentile(everything, 99):8.3f}ms")
+
+
+def populate(db_path: str, users: int, broadcast_users: int) -> dict:
+    """Пользователи с одним каналом каждый и получатели рассылки; вернуть {user_id: id канала}"""
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (user_id) VALUES (?)",
+        ((user_id,) for user_id in range(1, max(users, broadcast_users) + 1))
+    )
+    conn.executemany(
+        "INSERT INTO channels (user_id, channel_id, channel_name) VALUES (?, ?, ?)",
+        ((user_id, -1_000_000_000 - user_id, f"Канал {user_id}") for user_id in range(1, users + 1))
+    )
+    conn.commit()
+    channels = dict(conn.execute("SELECT user_id, id FROM channels"))
+    conn.close()
+    return channels
+
+
+async def run_fsm(malik, users: list, channels: dict):
+    scenario = Scenario("fsm: create post and save draft")
+
+    async def flow(user_id: int):
+        await scenario.feed(malik, "/start", message_update(user_id, "/start"))
+        await scenario.feed(malik, "create_post", callback_update(user_id, "create_post"))
+        await scenario.feed(malik, "select_ch", callback_update(user_id, f"select_ch_{channels[user_id]}"))
+        await scenario.feed(malik, "channels_done", callback_update(user_id, "channels_done"))
+        await scenario.feed(malik, "photo", message_update(user_id, photo=f"photo-{user_id}"))
+        await scenario.feed(malik, "continue_media", callback_update(user_id, "continue_media"))
+        await scenario.feed(malik, "description", message_update(user_id, f"Пост пользователя {user_id}"))
+        await scenario.feed(malik, "no_buttons", callback_update(user_id, "no"))
+        await scenario.feed(malik, "publish_now", callback_update(user_id, "publish_now"))
+        await scenario.feed(malik, "save_draft", callback_update(user_id, "save_draft"))
+
+    await asyncio.gather(*(flow(user_id) for user_id in users))
+    scenario.finish()
+
+
+async def run_albums(malik, api: FakeBotAPI, users: list, channels: dict, size: int):
+    scenario = Scenario(f"album: {size} photos per user")
+    album_latency = []
+
+    async def flow(user_id: int):
+        await scenario.feed(malik, "create_post", callback_update(user_id, "create_post"))
+        await scenario.feed(malik, "select_ch", callback_update(user_id, f"select_ch_{channels[user_id]}"))
+        await scenario.feed(malik, "channels_done", callback_update(user_id, "channels_done"))
+
+        expected = api.sent[user_id] + 1
+        started = time.perf_counter()
+        group = f"album-{user_id}"
+        await asyncio.gather(*(
+            scenario.feed(malik, "album item", message_update(user_id, photo=f"album-{user_id}-{i}", media_group_id=group))
+            for i in range(size)
+        ))
+        # Ответ на альбом приходит после окна склейки
+        await api.wait_sent(user_id, expected, timeout=30)
+        album_latency.append((time.perf_counter() - started) * 1000)
+        await scenario.feed(malik, "cancel", callback_update(user_id, "cancel"))
+
+    await asyncio.gather(*(flow(user_id) for user_id in users))
+    scenario.finish()
+    report("  album reply (incl. window)", album_latency)
+
+
+async def run_drafts(malik, users: list):
+    scenario = Scenario("drafts: list and open")
+
+    async def flow(user_id: int):
+        await scenario.feed(malik, "drafts", callback_update(user_id, "drafts"))
+        drafts = await malik.db.get_user_drafts(user_id)
+        if drafts:
+            await scenario.feed(malik, "draft", callback_update(user_id, f"draft_{drafts[0]['id']}"))
+
+    await asyncio.gather(*(flow(user_id) for user_id in users))
+    scenario.finish()
+
+
+async def run_broadcast(malik, api: FakeBotAPI, recipients: int):
+    scenario = Scenario(f"broadcast: {recipients} recipients")
+    admin_id = malik.ADMIN_IDS[0]
+    await scenario.feed(malik, "broadcast", callback_update(admin_id, "broadcast"))
+    await scenario.feed(malik, "broadcast message", message_update(admin_id, "Рассылка для бенчмарка"))
+
+    started = time.perf_counter()
+    while malik.broadcaster.busy:
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - started
+    job = malik.broadcaster.job
+    scenario.finish()
+    print(f"  sent {job.success} ok / {job.failed} failed in {elapsed:.2f}s "
+          f"({job.done / elapsed:.0f} msg/s), 429 answers: {sum(api.floods.values())}")
+
+
+async def run(args):
+    api = FakeBotAPI(latency=args.latency, jitter=args.jitter, flood_rate=args.flood_rate)
+    await api.start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # DB_PATH относительный: база бота создаётся во временной папке
+        os.chdir(tmp)
+        malik = load_bot()
+        # Ошибки хендлеров считаются в отчёте, трейсбеки только мешают
+        logging.getLogger("aiogram").setLevel(logging.CRITICAL)
+        await malik.db.init_db()
+        channels = populate(malik.DB_PATH, args.users, args.broadcast_users)
+
+        session = AiohttpSession(api=TelegramAPIServer.from_base(api.base_url))
+        session.middleware(malik.outbound)
+        session.middleware(malik.ApiMetricsMiddleware())
+        malik.bot = Bot(token=malik.BOT_TOKEN, session=session)
+
+        # Лимит Telegram (30 сообщ./сек) растянул бы рассылку на час:
+        # здесь измеряются накладные расходы самого бота
+        malik.outbound.set_rate_limit(args.broadcast_rate)
+        malik.broadcaster.workers = args.broadcast_workers
+
+        await malik.storage.start()
+        await malik.user_registry.start()
+        malik.dp.include_router(malik.router)
+        print(f"Fake Bot API at {api.base_url}: latency={args.latency}s flood_rate={args.flood_rate}; {memory()}")
+
+        users = list(range(1, args.users + 1))
+        try:
+            await run_fsm(malik, users, channels)
+            await run_albums(malik, api, users, channels, args.album_size)
+            await run_drafts(malik, users)
+            if args.broadcast_users:
+                await run_broadcast(malik, api, args.broadcast_users)
+        finally:
+            await malik.broadcaster.stop()
+            await malik.storage.close()
+            await malik.user_registry.close()
+            await malik.bot.session.close()
+            await malik.db.close()
+            await api.stop()
+            os.chdir(os.path.dirname(tmp))
+
+    print(f"\nAPI calls: {dict(api.calls.most_common())}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--album-size", type=int, default=3)
+    parser.add_argument("--broadcast-users", type=int, default=100_000)
+    parser.add_argument("--broadcast-rate", type=float, default=100_000, help="сообщений в секунду вместо 30")
+    parser.add_argument("--broadcast-workers", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа фейкового API, сек")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля ответов 429")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,73 @@
+"""Микро-бенчмарк рендера поста: старая сборка против PostRenderer.
+
+Старый код на каждую отправку заново строил InlineKeyboardMarkup и
+InputMedia*. PostRenderer компилирует пост в SendPlan один раз и
+отдаёт его из кэша при предпросмотре, публикации и fan-out.
+
+compile - холодный путь со сброшенным кэшем: почти всё время уходит на
+те же объекты pydantic, что и у legacy, плюс сборка плана, поэтому он на
+3-15% медленнее старого кода. Выигрыш даёт только cached.
+
+Запуск: python benchmarks/bench_render.py [--iterations N]
+"""
+import argparse
+import time
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo
+
+from common import load_bot
+
+TEXT = "Пост для бенчмарка " * 20
+BUTTONS = [{"text": f"Кнопка {i}", "url": f"https://example.com/{i}"} for i in range(5)]
+SHAPES = {
+    "text only": [],
+    "single photo": [{"type": "photo", "file_id": "photo-0"}],
+    "album 5": [{"type": "photo" if i % 2 else "video", "file_id": f"file-{i}"} for i in range(5)],
+}
+
+
+def legacy_render(text, media, buttons):
+    """Сборка объектов так, как это делали хендлеры до PostRenderer"""
+    post_buttons = []
+    for btn in buttons:
+        post_buttons.append([InlineKeyboardButton(text=btn["text"], url=btn["url"])])
+    keyboard = InlineKeyboardMarkup(inline_keyboard=post_buttons) if post_buttons else None
+
+    media_group = []
+    if len(media) > 1:
+        for i, m in enumerate(media):
+            if m["type"] == "photo":
+                media_group.append(InputMediaPhoto(media=m["file_id"], caption=text if i == 0 else None))
+            elif m["type"] == "video":
+                media_group.append(InputMediaVideo(media=m["file_id"], caption=text if i == 0 else None))
+    return keyboard, media_group
+
+
+def bench(func, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 1_000_000
+
+
+def run(iterations: int):
+    malik = load_bot()
+    renderer = malik.PostRenderer()
+
+    for name, media in SHAPES.items():
+        legacy = bench(lambda: legacy_render(TEXT, media, BUTTONS), iterations)
+
+        def cold():
+            renderer._compile.cache_clear()
+            renderer.compile(TEXT, media, BUTTONS)
+
+        compiled = bench(cold, iterations)
+        cached = bench(lambda: renderer.compile(TEXT, media, BUTTONS), iterations)
+        print(f"{name:<14} legacy={legacy:8.2f}us  compile={compiled:8.2f}us  cached={cached:8.2f}us")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+    run(args.iterations)
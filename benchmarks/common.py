@@ -0,0 +1,50 @@
+"""Общие помощники для бенчмарков MalikPost.
+
+Основной модуль бота называется ``python Malik.py`` и не импортируется
+обычным ``import``, поэтому загружаем его по пути к файлу.
+"""
+import importlib.util
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_FILE = os.path.join(ROOT, "python Malik.py")
+
+
+def load_bot():
+    """Загрузить модуль бота (без запуска main)"""
+    if "malik" in sys.modules:
+        return sys.modules["malik"]
+    spec = importlib.util.spec_from_file_location("malik", BOT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["malik"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+async def measure(func, iterations: int) -> list:
+    """Выполнить корутину iterations раз, вернуть задержки в мс"""
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def percentile(samples: list, pct: float) -> float:
+    """Перцентиль по отсортированной выборке"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(name: str, samples: list):
+    """Напечатать строку отчёта"""
+    print(
+        f"{name:<40} mean={statistics.mean(samples):8.3f}ms "
+        f"p50={percentile(samples, 50):8.3f}ms p99={percentile(samples, 99):8.3f}ms "
+        f"n={len(samples)}"
+    )
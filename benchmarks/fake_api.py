@@ -0,0 +1,128 @@
+"""Фейковый Telegram Bot API для нагрузочных тестов.
+
+Отвечает на запросы бота правдоподобными объектами, добавляет задержку
+и с заданной вероятностью отвечает 429 (flood control). Подключается к
+боту через TelegramAPIServer.from_base(api.base_url).
+"""
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+FLOOD_METHODS = ("send", "copy", "edit", "forward")
+ADMIN_RIGHTS = (
+    "can_be_edited", "is_anonymous", "can_manage_chat", "can_delete_messages",
+    "can_manage_video_chats", "can_restrict_members", "can_promote_members",
+    "can_change_info", "can_invite_users", "can_post_stories", "can_edit_stories",
+    "can_delete_stories", "can_post_messages", "can_edit_messages",
+)
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, flood_rate: float = 0.0,
+                 retry_after: int = 1, seed: int = 42):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.floods = Counter()
+        self._rng = random.Random(seed)
+        self.sent = Counter()
+        self._message_id = 0
+        self._waiters: dict = {}
+        self._runner = None
+        self.base_url = ""
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def wait_sent(self, chat_id: int, count: int, timeout: float = 10.0):
+        """Дождаться, пока бот отправит в чат count сообщений"""
+        if self.sent[chat_id] >= count:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(chat_id, []).append((count, future))
+        await asyncio.wait_for(future, timeout)
+
+    def _record_sent(self, chat_id: int, count: int = 1):
+        self.sent[chat_id] += count
+        waiters = self._waiters.get(chat_id)
+        if not waiters:
+            return
+        for waiter in [w for w in waiters if w[0] <= self.sent[chat_id]]:
+            waiters.remove(waiter)
+            if not waiter[1].done():
+                waiter[1].set_result(None)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter)))
+
+        if self.flood_rate and method.startswith(FLOOD_METHODS) and self._rng.random() < self.flood_rate:
+            self.floods[method] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    def _message(self, chat_id: int, text: str = None) -> dict:
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"},
+        }
+        if text:
+            message["text"] = text
+        return message
+
+    def _result(self, method: str, params: dict):
+        chat_id = int(params.get("chat_id", 0) or 0)
+
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        if method == "getChat":
+            return {"id": chat_id, "type": "channel", "title": f"Channel {chat_id}",
+                    "accent_color_id": 0, "max_reaction_count": 11}
+        if method == "getChatMember":
+            member = {"status": "administrator", "user": {"id": int(params["user_id"]), "is_bot": True, "first_name": "Fake"}}
+            member.update({right: True for right in ADMIN_RIGHTS})
+            return member
+        if method == "getFile":
+            return {"file_id": params["file_id"], "file_unique_id": params["file_id"], "file_size": 1024}
+        if method == "sendMediaGroup":
+            media = json.loads(params["media"])
+            self._record_sent(chat_id, len(media))
+            return [self._message(chat_id) for _ in media]
+        if method == "copyMessage":
+            self._record_sent(chat_id)
+            return {"message_id": self._message(chat_id)["message_id"]}
+        if method.startswith("send") or method.startswith("edit"):
+            if method.startswith("send"):
+                self._record_sent(chat_id)
+            return self._message(chat_id, params.get("text"))
+        return True
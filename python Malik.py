@@ -1,27 +1,133 @@
 import asyncio
+import hashlib
+import heapq
+import hmac
+import itertools
+import html
+import inspect
 import logging
+import math
 import json
+import multiprocessing
+import os
+import random
+import secrets
+import signal
+import socket
+import time
 import aiosqlite
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional
-from flask import Flask
-from threading import Thread
+from functools import lru_cache, wraps
+from types import MappingProxyType
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Dict, Optional
+from aiohttp import web
 
-from aiogram import Bot, Dispatcher, F, Router
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton,
-    InputMediaPhoto, InputMediaVideo, FSInputFile
+    InputMediaPhoto, InputMediaVideo, FSInputFile, TelegramObject, ChatMemberUpdated, Chat, User
+)
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramEntityTooLarge, TelegramForbiddenError, TelegramNotFound,
+    TelegramRetryAfter, TelegramUnauthorizedError
 )
-from aiogram.exceptions import TelegramBadRequest
 
 # ==================== КОНФИГУРАЦИЯ ====================
 BOT_TOKEN = "8592304393:AAHOjr7XmPqUGgAfw7eiSNnC2EFCFviU_4w"
 ADMIN_IDS = [8351408424, 8429224001]
 DB_PATH = "malik_post.db"
+DB_READERS = 4  # Соединений-читателей в пуле (писатель всегда один)
+USERS_CHUNK_SIZE = 1000  # Пользователей за один запрос при переборе
+SQLITE_PRAGMAS = (
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+)
+SCHEDULER_CONCURRENCY = 20  # Одновременных публикаций отложенных постов
+SCHEDULER_BATCH = 100  # Сколько созревших постов забирать за одну транзакцию
+SCHEDULE_INPUT_FORMAT = "%d.%m.%Y %H:%M"
+SCHEDULE_DB_FORMAT = "%Y-%m-%d %H:%M:%S"
+TELEGRAM_GLOBAL_RATE = 30  # Сообщений в секунду на бота (лимит Telegram)
+TELEGRAM_CHAT_INTERVAL = 1.0  # Секунд между сообщениями в один чат
+TELEGRAM_GROUP_INTERVAL = 3.0  # Секунд между сообщениями в один канал/группу (20 в минуту)
+TELEGRAM_CHAT_BURST = 3  # Сообщений подряд в один чат, после которых включается интервал
+OUTBOUND_MIN_RATE = 5  # Ниже этой скорости (сообщ./сек) лимит после RetryAfter не опускается
+OUTBOUND_GLOBAL_FLOOD_CHATS = 3  # RetryAfter в стольких разных чатах за OUTBOUND_RECOVERY_INTERVAL - общий лимит бота
+OUTBOUND_RECOVERY_INTERVAL = 10.0  # Секунд без RetryAfter, после которых скорость растёт на шаг
+OUTBOUND_RETRIES = 3  # Повторов запроса после RetryAfter
+OUTBOUND_MAX_RETRY_WAIT = 30  # Дольше этого (сек) не ждём, а отдаём ошибку вызывающему
+OUTBOUND_FOLLOWER_SHARE = 0.3  # Доля TELEGRAM_GLOBAL_RATE на ответы всех воркеров-нелидеров вместе
+FANOUT_CONCURRENCY = 10  # Каналов, в которые пост публикуется одновременно
+OUTBOX_MAX_ATTEMPTS = 6  # Попыток доставки поста, после которых он уходит в dead-letter
+OUTBOX_BASE_DELAY = 2.0  # Секунд до первого повтора, дальше задержка удваивается
+OUTBOX_MAX_DELAY = 300.0  # Максимальная задержка между повторами
+OUTBOX_RETENTION = 7 * 24 * 3600  # Сколько секунд хранить завершённые публикации и их ключи
+OUTBOX_CLEANUP_INTERVAL = 3600
+BROADCAST_WORKERS = 25
+BROADCAST_PROGRESS_INTERVAL = 3.0  # Секунд между обновлениями статуса рассылки
+BROADCAST_CHECKPOINT_INTERVAL = 1.0  # Секунд между сохранениями прогресса рассылки в БД
+FSM_FLUSH_INTERVAL = 0.5  # Секунд между пакетной записью FSM-сессий
+FSM_CACHE_SIZE = 10000  # FSM-сессий в памяти
+FSM_SESSION_TTL = 48 * 3600  # Через сколько секунд бездействия сессия удаляется
+FSM_CLEANUP_INTERVAL = 3600
+USERS_FLUSH_INTERVAL = 0.5  # Секунд между пакетной записью новых пользователей и их активности
+USERS_CACHE_SIZE = 100000  # Пользователей, чьи username и last_seen держим в памяти
+USERS_SEEN_INTERVAL = 3600  # Не чаще раза в столько секунд обновлять last_seen пользователя
+USERS_BLOOM_CAPACITY = 1000000  # Пользователей, на которых рассчитан bloom-фильтр
+USERS_BLOOM_ERROR_RATE = 0.01
+MEDIA_GROUP_WINDOW = 0.6  # Секунд ожидания следующего файла альбома
+MAX_MEDIA = 5
+DRAFTS_LIMIT = 200  # Черновиков на пользователя, старейшие сверх лимита удаляются
+DRAFTS_PAGE_SIZE = 8  # Черновиков на странице списка
+DRAFT_PREVIEW_LENGTH = 30  # Символов текста в списке черновиков
+MEDIA_VALIDATE_AHEAD = 3600  # За сколько секунд до публикации проверять файлы отложенных постов
+MEDIA_VALIDATION_TTL = 6 * 3600  # Сколько секунд проверка file_id считается свежей
+MEDIA_CHECK_INTERVAL = 300  # Секунд между проходами проверки файлов
+MEDIA_CHECK_BATCH = 100  # Файлов за один проход
+CAPTION_LIMIT = 1024  # Максимальная длина подписи к медиа в Telegram
+RENDER_CACHE_SIZE = 512  # Скомпилированных постов в кэше
+CHANNEL_CACHE_SIZE = 5000  # Пользователей, чьи каналы держим в памяти
+CHANNEL_CACHE_TTL = 300  # Секунд жизни кэша каналов
+KEYBOARD_CACHE_SIZE = 32  # Собранных клавиатур на пользователя
+METADATA_CACHE_SIZE = 10000  # Чатов и участников в кэше метаданных Telegram
+METADATA_CACHE_TTL = 300  # Секунд жизни get_chat/get_chat_member в кэше
+CHANNEL_RECHECK_INTERVAL = 24 * 3600  # Раз в столько секунд перепроверять права бота в каждом канале
+CHANNEL_RECHECK_POLL = 600  # Секунд между проходами перепроверки
+CHANNEL_RECHECK_BATCH = 50  # Каналов за один запрос к БД
+CHANNEL_RECHECK_CONCURRENCY = 3  # Одновременных get_chat_member при перепроверке
+USER_LANE_MAX_PENDING = 20  # Апдейтов пользователя в очереди, сверх этого новые отбрасываются
+FLOOD_USER_RATE = 5  # Апдейтов в секунду от одного пользователя в среднем
+FLOOD_USER_BURST = 20  # Апдейтов подряд сверх среднего (альбом из 10 фото и т.п.)
+FLOOD_CALLBACK_RATE = 2  # Нажатий в секунду на кнопки одного типа (префикс callback_data)
+FLOOD_CALLBACK_BURST = 6
+FLOOD_SELECTION_ROUTES = ("select_ch",)  # Кнопки выбора каналов: десятки нажатий подряд на одном сообщении
+FLOOD_SELECTION_RATE = 10  # Нажатий в секунду на кнопки выбора, вместо лимитов кнопки и пользователя
+FLOOD_SELECTION_BURST = 60
+FLOOD_DUPLICATE_WINDOW = 1.0  # Секунд, в течение которых повторное нажатие той же кнопки игнорируется
+FLOOD_CACHE_SIZE = 100000  # Пользователей и кнопок, чьи лимиты держим в памяти
+RUN_MODE = "polling"  # "polling" или "webhook"
+WEB_HOST = "0.0.0.0"
+WEB_PORT = 8080  # Порт HTTP-сервера (health-check и вебхук)
+METRICS_HOST = "127.0.0.1"  # /metrics не публикуется наружу вместе с вебхуком
+METRICS_PORT = 9090  # Порт /metrics; в режиме воркеров у воркера METRICS_PORT + 1 + номер
+WEBHOOK_URL = ""  # Публичный адрес, например https://example.repl.co
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = ""  # Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; пустой - случайный при каждом запуске
+WEBHOOK_MAX_CONNECTIONS = 40  # Одновременных соединений от Telegram
+WEBHOOK_MAX_INFLIGHT = 200  # Апдейтов в обработке, после которых вебхук ждёт
+SHUTDOWN_TIMEOUT = 10.0  # Секунд на завершение апдейтов в обработке при остановке
+WORKERS = 1  # Процессов-обработчиков апдейтов; больше 1 - режим воркеров
+LEADER_LEASE_TTL = 15.0  # Секунд, на которые лидер арендует фоновые задачи
+LEADER_RENEW_INTERVAL = 5.0  # Секунд между продлениями аренды и синхронизацией задач
 
 # ==================== НАСТРОЙКА ЛОГИРОВАНИЯ ====================
 logging.basicConfig(
@@ -30,20 +136,274 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# ==================== KEEP-ALIVE ДЛЯ REPLIT ====================
-app = Flask('')
+# ==================== МЕТРИКИ ====================
+def escape_label(value: Any) -> str:
+    """Экранировать значение метки для текстового формата Prometheus"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
-@app.route('/')
-def home():
-    return "MalikPost Bot is alive! 🚀"
 
-def run_flask():
-    app.run(host='0.0.0.0', port=8080)
+class Metric:
+    """Метрика в текстовом формате Prometheus со значениями по наборам меток"""
 
-def keep_alive():
-    t = Thread(target=run_flask)
-    t.daemon = True
-    t.start()
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: Dict[tuple, Any] = {}
+
+    def _format_labels(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._format_labels(key)} {value}" for key, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        # [счётчики по корзинам..., сумма, количество]
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, series in self._values.items():
+            counts = series[:len(self.buckets)] + [series[-1]]
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Набор метрик процесса, отдаётся по /metrics"""
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.register(Histogram(
+    "malik_handler_seconds", "Handler latency", ("handler", "route", "state")))
+HANDLER_ERRORS = metrics.register(Counter(
+    "malik_handler_errors_total", "Handler exceptions", ("handler", "error")))
+API_LATENCY = metrics.register(Histogram(
+    "malik_api_seconds", "Telegram Bot API call latency", ("method",)))
+API_ERRORS = metrics.register(Counter(
+    "malik_api_errors_total", "Telegram Bot API call errors", ("method", "error")))
+DB_LATENCY = metrics.register(Histogram(
+    "malik_db_seconds", "Database call latency", ("method",)))
+BROADCAST_SENT = metrics.register(Counter(
+    "malik_broadcast_messages_total", "Broadcast messages by result", ("result",)))
+SCHEDULER_LAG = metrics.register(Histogram(
+    "malik_scheduler_lag_seconds", "Delay between scheduled and actual publish time", (),
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)))
+OUTBOUND_QUEUE = metrics.register(Gauge(
+    "malik_outbound_queue_depth", "Bot API requests waiting for a rate limit slot", ("lane",)))
+OUTBOUND_RATE = metrics.register(Gauge(
+    "malik_outbound_rate", "Current global send rate, messages per second"))
+METADATA_LOOKUPS = metrics.register(Counter(
+    "malik_metadata_lookups_total", "Telegram metadata lookups by kind and result (hit, miss, coalesced)",
+    ("kind", "result")))
+OUTBOUND_FLOODS = metrics.register(Counter(
+    "malik_outbound_retry_after_total", "RetryAfter answers from Telegram", ("method", "lane")))
+USER_LANES = metrics.register(Gauge(
+    "malik_user_lanes", "Users with updates in processing or waiting"))
+USER_LANE_WAIT = metrics.register(Histogram(
+    "malik_user_lane_wait_seconds", "Time an update waits for earlier updates of the same user"))
+USER_LANE_DROPS = metrics.register(Counter(
+    "malik_user_lane_dropped_total", "Updates dropped because the user queue is full", ("event",)))
+FLOOD_DROPS = metrics.register(Counter(
+    "malik_flood_dropped_total", "Updates dropped by anti-flood (user, callback, duplicate)", ("reason", "event")))
+
+
+def timed(histogram: Histogram):
+    """Декоратор: время выполнения корутины в histogram с меткой имени функции"""
+    def decorator(func):
+        name = func.__name__
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorator
+
+
+def instrument(cls, histogram: Histogram):
+    """Обернуть timed() все публичные корутины класса"""
+    for name, member in list(vars(cls).items()):
+        if not name.startswith("_") and inspect.iscoroutinefunction(member):
+            setattr(cls, name, timed(histogram)(member))
+    return cls
+
+# ==================== HTTP-СЕРВЕР ====================
+class UpdateFeeder:
+    """Фоновая обработка сырых апдейтов диспетчером.
+
+    Число апдейтов в работе ограничено: при перегрузке feed() ждёт, и это
+    замедляет источник (ответ вебхуку или чтение очереди воркера). При
+    остановке drain() дожидается начатых апдейтов.
+    """
+
+    def __init__(self, limit: int = WEBHOOK_MAX_INFLIGHT):
+        self._tasks: set = set()
+        self._slots = asyncio.Semaphore(limit)
+
+    @property
+    def inflight(self) -> int:
+        return len(self._tasks)
+
+    async def feed(self, update: Dict[str, Any]):
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """Дождаться апдейтов в обработке, по таймауту отменить оставшиеся"""
+        if not self._tasks:
+            return
+        logger.info(f"Waiting for {len(self._tasks)} in-flight updates")
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Cancelled {len(pending)} updates on shutdown")
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _process(self, update: Dict[str, Any]):
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logger.exception(f"Error processing update: {e}")
+        finally:
+            self._slots.release()
+
+
+class WebServer:
+    """aiohttp-сервер: health-check для Replit/UptimeRobot и приём вебхука.
+
+    Апдейт из вебхука передаётся в feed (UpdateFeeder или роутер воркеров),
+    Telegram сразу получает ответ 200. После close_intake() новые апдейты
+    отклоняются с 503, и Telegram повторит их после перезапуска.
+    Метрики отдаёт отдельный экземпляр на METRICS_HOST (см. enable_metrics).
+    """
+
+    def __init__(self, host: str = WEB_HOST, port: int = WEB_PORT):
+        self.host = host
+        self.port = port
+        self.app = web.Application()
+        self.app.router.add_get("/", self._home)
+        self.app.router.add_get("/health", self._health)
+        self._runner: Optional[web.AppRunner] = None
+        self._feed: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+        self._secret = ""
+        self._draining = False
+
+    def enable_webhook(self, feed: Callable[[Dict[str, Any]], Awaitable[None]], secret: str,
+                       path: str = WEBHOOK_PATH):
+        """Зарегистрировать обработчик вебхука (до start()); апдейты без secret отклоняются"""
+        if not secret:
+            raise ValueError("Webhook secret is required")
+        self._feed = feed
+        self._secret = secret
+        self.app.router.add_post(path, self._webhook)
+
+    def enable_metrics(self):
+        """Отдавать /metrics (до start())"""
+        self.app.router.add_get("/metrics", self._metrics)
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"HTTP server listening on {self.host}:{self.port}")
+
+    def close_intake(self):
+        """Перестать принимать апдейты"""
+        self._draining = True
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _home(self, request: web.Request) -> web.Response:
+        return web.Response(text="MalikPost Bot is alive! 🚀")
+
+    async def _health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "draining" if self._draining else "ok",
+            "mode": RUN_MODE,
+            "workers": WORKERS,
+        })
+
+    async def _metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain")
+
+    async def _webhook(self, request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, self._secret):
+            return web.Response(status=401)
+        if self._draining:
+            # Telegram повторит апдейт, когда бот поднимется снова
+            return web.Response(status=503)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await self._feed(update)
+        return web.Response()
 
 # ==================== FSM СОСТОЯНИЯ ====================
 class PostCreation(StatesGroup):
@@ -63,94 +423,360 @@ class ChannelManagement(StatesGroup):
 class AdminPanel(StatesGroup):
     broadcast_message = State()
 
+# ==================== МИГРАЦИИ ====================
+def add_column(table: str, column: str, ddl: str):
+    """Шаг миграции: добавить колонку, если её ещё нет"""
+    async def step(db: aiosqlite.Connection):
+        async with db.execute(f"PRAGMA table_info({table})") as cursor:
+            columns = {row[1] for row in await cursor.fetchall()}
+        if column not in columns:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    return step
+
+# (версия, описание, шаги). Шаг - SQL-строка или корутина от соединения.
+# Версия схемы хранится в PRAGMA user_version; шаги пишутся идемпотентно,
+# чтобы их можно было применить к базе, созданной до появления миграций.
+MIGRATIONS = [
+    (1, "initial schema", [
+        """CREATE TABLE IF NOT EXISTS users (
+               user_id INTEGER PRIMARY KEY,
+               username TEXT,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )""",
+        """CREATE TABLE IF NOT EXISTS channels (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               user_id INTEGER,
+               channel_id INTEGER,
+               channel_name TEXT,
+               is_admin BOOLEAN DEFAULT 1,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               FOREIGN KEY (user_id) REFERENCES users(user_id)
+           )""",
+        """CREATE TABLE IF NOT EXISTS drafts (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               user_id INTEGER,
+               channel_id INTEGER,
+               text TEXT,
+               media TEXT,
+               buttons TEXT,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               FOREIGN KEY (user_id) REFERENCES users(user_id)
+           )""",
+        """CREATE TABLE IF NOT EXISTS scheduled_posts (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               user_id INTEGER,
+               channel_id INTEGER,
+               text TEXT,
+               media TEXT,
+               buttons TEXT,
+               publish_time TIMESTAMP,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               FOREIGN KEY (user_id) REFERENCES users(user_id)
+           )""",
+    ]),
+    (2, "scheduled post status", [
+        add_column("scheduled_posts", "status", "TEXT NOT NULL DEFAULT 'pending'"),
+        "CREATE INDEX IF NOT EXISTS idx_scheduled_status_time ON scheduled_posts (status, publish_time)",
+    ]),
+    (3, "broadcasts", [
+        """CREATE TABLE IF NOT EXISTS broadcasts (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               admin_id INTEGER,
+               from_chat_id INTEGER,
+               message_id INTEGER,
+               status_chat_id INTEGER,
+               status_message_id INTEGER,
+               status TEXT NOT NULL DEFAULT 'running',
+               cursor INTEGER NOT NULL DEFAULT 0,
+               success INTEGER NOT NULL DEFAULT 0,
+               failed INTEGER NOT NULL DEFAULT 0,
+               total INTEGER NOT NULL DEFAULT 0,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               finished_at TIMESTAMP
+           )""",
+    ]),
+    (4, "fsm storage", [
+        """CREATE TABLE IF NOT EXISTS fsm_storage (
+               key TEXT PRIMARY KEY,
+               state TEXT,
+               data TEXT,
+               updated_at REAL NOT NULL
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm_storage (updated_at)",
+    ]),
+    (5, "channel and draft indexes", [
+        # Перед уникальным индексом убираем дубли, оставляя последнюю запись
+        """DELETE FROM channels WHERE id NOT IN (
+               SELECT MAX(id) FROM channels GROUP BY user_id, channel_id
+           )""",
+        # Один канал на пользователя; индекс же обслуживает поиск канала
+        # и JOIN черновиков с каналами по (user_id, channel_id)
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_channels_user_channel ON channels (user_id, channel_id)",
+        # Список, подсчёт и вытеснение старейших черновиков пользователя
+        "CREATE INDEX IF NOT EXISTS idx_drafts_user_created ON drafts (user_id, created_at)",
+    ]),
+    (6, "leases", [
+        # Аренда фоновых задач (планировщик, рассылки) одним из воркеров
+        """CREATE TABLE IF NOT EXISTS leases (
+               name TEXT PRIMARY KEY,
+               holder TEXT NOT NULL,
+               expires_at REAL NOT NULL
+           )""",
+    ]),
+    (7, "draft media and button counts", [
+        # Список черновиков показывает число медиа без разбора JSON
+        add_column("drafts", "media_count", "INTEGER NOT NULL DEFAULT 0"),
+        add_column("drafts", "buttons_count", "INTEGER NOT NULL DEFAULT 0"),
+        """UPDATE drafts SET
+               media_count = CASE WHEN json_valid(media) THEN json_array_length(media) ELSE 0 END,
+               buttons_count = CASE WHEN json_valid(buttons) THEN json_array_length(buttons) ELSE 0 END""",
+    ]),
+    (8, "media registry", [
+        # Один файл Telegram - одна строка, сколько бы черновиков и постов его ни использовали
+        """CREATE TABLE IF NOT EXISTS media (
+               file_unique_id TEXT PRIMARY KEY,
+               file_id TEXT NOT NULL,
+               type TEXT NOT NULL,
+               file_size INTEGER,
+               valid INTEGER NOT NULL DEFAULT 1,
+               last_validated REAL
+           )""",
+    ]),
+    (9, "publish outbox", [
+        # Публикации в каналы: сначала запись, потом доставка фоновым циклом
+        """CREATE TABLE IF NOT EXISTS outbox (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               idempotency_key TEXT NOT NULL UNIQUE,
+               batch TEXT NOT NULL,
+               user_id INTEGER NOT NULL,
+               chat_id INTEGER NOT NULL,
+               channel_name TEXT,
+               text TEXT,
+               media TEXT,
+               buttons TEXT,
+               draft_id INTEGER,
+               scheduled_post_id INTEGER,
+               report_chat_id INTEGER,
+               report_message_id INTEGER,
+               status TEXT NOT NULL DEFAULT 'pending',
+               attempts INTEGER NOT NULL DEFAULT 0,
+               progress INTEGER NOT NULL DEFAULT 0,
+               next_attempt_at REAL NOT NULL,
+               last_error TEXT,
+               finished_at REAL
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON outbox (status, next_attempt_at)",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_batch ON outbox (batch)",
+    ]),
+    (10, "user last seen", [
+        add_column("users", "last_seen", "REAL"),
+    ]),
+    (11, "channel status checks", [
+        # Когда права бота в канале проверялись последний раз (my_chat_member или get_chat_member)
+        add_column("channels", "checked_at", "REAL NOT NULL DEFAULT 0"),
+        "CREATE INDEX IF NOT EXISTS idx_channels_checked ON channels (checked_at)",
+    ]),
+    (12, "covering channel list index", [
+        # Покрывающий индекс get_user_channels: WHERE user_id, ORDER BY id и все
+        # выбираемые колонки - без чтения строк таблицы и без сортировки
+        """CREATE INDEX IF NOT EXISTS idx_channels_user_list
+           ON channels (user_id, id, channel_id, channel_name, is_admin)""",
+    ]),
+]
+
 # ==================== БАЗА ДАННЫХ ====================
 class Database:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, readers: int = DB_READERS):
         self.db_path = db_path
+        self.readers = readers
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._pool: Optional[asyncio.Queue] = None
+        self._connections: List[aiosqlite.Connection] = []
+
+    async def _connect(self, read_only: bool = False) -> aiosqlite.Connection:
+        """Открыть соединение с настроенными PRAGMA"""
+        conn = await aiosqlite.connect(self.db_path)
+        for pragma in SQLITE_PRAGMAS:
+            await conn.execute(pragma)
+        if read_only:
+            await conn.execute("PRAGMA query_only = ON")
+        self._connections.append(conn)
+        return conn
+
+    async def open(self):
+        """Открыть пул: один писатель и несколько читателей"""
+        if self._writer is not None:
+            return
+        self._write_lock = asyncio.Lock()
+        self._writer = await self._connect()
+        # WAL сохраняется в файле БД, достаточно включить один раз на писателе
+        async with self._writer.execute("PRAGMA journal_mode = WAL") as cursor:
+            await cursor.fetchone()
+        self._pool = asyncio.Queue()
+        for _ in range(self.readers):
+            self._pool.put_nowait(await self._connect(read_only=True))
+
+    async def close(self):
+        """Закрыть все соединения пула"""
+        connections, self._connections = self._connections, []
+        self._writer = None
+        self._pool = None
+        for conn in connections:
+            await conn.close()
+
+    @asynccontextmanager
+    async def _read(self):
+        """Взять соединение-читатель из пула"""
+        conn = await self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def _write(self, immediate: bool = False):
+        """Эксклюзивный доступ к писателю, коммит по выходу из блока.
+
+        immediate - сразу взять блокировку записи на файл: нужно, когда
+        транзакция сначала читает, а потом пишет, а БД открыта несколькими
+        процессами.
+        """
+        async with self._write_lock:
+            try:
+                if immediate:
+                    await self._writer.execute("BEGIN IMMEDIATE")
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            await self._writer.commit()
 
     async def init_db(self):
         """Инициализация базы данных"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS channels (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    channel_id INTEGER,
-                    channel_name TEXT,
-                    is_admin BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            """)
-
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS drafts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    channel_id INTEGER,
-                    text TEXT,
-                    media TEXT,
-                    buttons TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            """)
-
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS scheduled_posts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    channel_id INTEGER,
-                    text TEXT,
-                    media TEXT,
-                    buttons TEXT,
-                    publish_time TIMESTAMP,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+        await self.open()
+        await self.migrate()
+
+    async def schema_version(self) -> int:
+        """Текущая версия схемы"""
+        async with self._read() as db:
+            async with db.execute("PRAGMA user_version") as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def migrate(self, target: Optional[int] = None):
+        """Применить недостающие миграции (до версии target включительно)"""
+        version = await self.schema_version()
+        for migration_version, description, steps in MIGRATIONS:
+            if migration_version <= version or (target is not None and migration_version > target):
+                continue
+            # Каждая миграция - одна транзакция вместе с новой версией схемы
+            async with self._write(immediate=True) as db:
+                for step in steps:
+                    if callable(step):
+                        await step(db)
+                    else:
+                        await db.execute(step)
+                await db.execute(f"PRAGMA user_version = {migration_version}")
+            logger.info(f"Database migrated to version {migration_version}: {description}")
+
+    async def save_users(self, inserts: List[tuple], updates: List[tuple]):
+        """Записать новых пользователей и их активность одной транзакцией.
+
+        inserts - (user_id, username, last_seen): новые или с /start,
+        updates - (username, last_seen, user_id): только существующие.
+        """
+        async with self._write() as db:
+            if inserts:
+                await db.executemany(
+                    """INSERT INTO users (user_id, username, last_seen) VALUES (?, ?, ?)
+                       ON CONFLICT(user_id) DO UPDATE SET
+                           username = excluded.username, last_seen = excluded.last_seen""",
+                    inserts
                 )
-            """)
-
-            await db.commit()
-
-    async def add_user(self, user_id: int, username: str = None):
-        """Добавить пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
-                (user_id, username)
-            )
-            await db.commit()
-
-    async def get_all_users(self) -> List[int]:
-        """Получить всех пользователей"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute("SELECT user_id FROM users") as cursor:
-                rows = await cursor.fetchall()
-                return [row[0] for row in rows]
+            if updates:
+                await db.executemany("UPDATE users SET username = ?, last_seen = ? WHERE user_id = ?", updates)
+
+    async def iter_users(self, after: int = 0, chunk_size: int = USERS_CHUNK_SIZE) -> AsyncIterator[int]:
+        """Перебрать user_id по возрастанию порциями (keyset-пагинация).
+
+        Соединение занято только на время чтения порции, а в памяти
+        одновременно не больше chunk_size идентификаторов.
+        """
+        while True:
+            async with self._read() as db:
+                async with db.execute(
+                    "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                    (after, chunk_size)
+                ) as cursor:
+                    rows = await cursor.fetchall()
+            for row in rows:
+                yield row[0]
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1][0]
+
+    async def count_users(self) -> int:
+        """Количество пользователей"""
+        async with self._read() as db:
+            async with db.execute("SELECT COUNT(*) FROM users") as cursor:
+                return (await cursor.fetchone())[0]
 
     async def add_channel(self, user_id: int, channel_id: int, channel_name: str, is_admin: bool = True):
         """Добавить канал"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute(
-                """INSERT INTO channels (user_id, channel_id, channel_name, is_admin) 
-                   VALUES (?, ?, ?, ?)""",
-                (user_id, channel_id, channel_name, is_admin)
+                """INSERT INTO channels (user_id, channel_id, channel_name, is_admin, checked_at)
+                   VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (user_id, channel_id) DO UPDATE SET
+                       channel_name = excluded.channel_name, is_admin = excluded.is_admin,
+                       checked_at = excluded.checked_at""",
+                (user_id, channel_id, channel_name, is_admin, time.time())
             )
-            await db.commit()
+
+    async def set_channel_admin(self, channel_id: int, is_admin: Optional[bool],
+                                channel_name: Optional[str] = None) -> List[int]:
+        """Обновить права бота в канале у всех пользователей, добавивших его.
+
+        is_admin=None - только отметить, что канал проверен. Вернуть
+        user_id, у которых статус или название канала изменились.
+        """
+        async with self._write() as db:
+            changed = []
+            if is_admin is not None:
+                async with db.execute(
+                    """UPDATE channels SET is_admin = ?, channel_name = coalesce(?, channel_name)
+                       WHERE channel_id = ? AND (is_admin != ? OR channel_name != coalesce(?, channel_name))
+                       RETURNING user_id""",
+                    (is_admin, channel_name, channel_id, is_admin, channel_name)
+                ) as cursor:
+                    changed = [row[0] for row in await cursor.fetchall()]
+            await db.execute("UPDATE channels SET checked_at = ? WHERE channel_id = ?", (time.time(), channel_id))
+            return changed
+
+    async def get_channels_to_check(self, before: float, limit: int) -> List[int]:
+        """Каналы, права в которых не проверялись с before"""
+        async with self._read() as db:
+            async with db.execute(
+                "SELECT DISTINCT channel_id FROM channels WHERE checked_at < ? LIMIT ?",
+                (before, limit)
+            ) as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+
+    async def is_channel_admin(self, user_id: int, channel_id: int) -> bool:
+        """Известно ли, что бот админ канала (канал без записи считается доступным)"""
+        async with self._read() as db:
+            async with db.execute(
+                "SELECT is_admin FROM channels WHERE user_id = ? AND channel_id = ?",
+                (user_id, channel_id)
+            ) as cursor:
+                row = await cursor.fetchone()
+                return row is None or bool(row[0])
 
     async def get_user_channels(self, user_id: int) -> List[Dict]:
         """Получить каналы пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(
-                "SELECT id, channel_id, channel_name, is_admin FROM channels WHERE user_id = ?",
+                "SELECT id, channel_id, channel_name, is_admin FROM channels WHERE user_id = ? ORDER BY id",
                 (user_id,)
             ) as cursor:
                 rows = await cursor.fetchall()
@@ -164,71 +790,78 @@ class Database:
                     for row in rows
                 ]
 
-    async def delete_channel(self, channel_db_id: int):
-        """Удалить канал"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("DELETE FROM channels WHERE id = ?", (channel_db_id,))
-            await db.commit()
+    async def delete_channel(self, channel_db_id: int, user_id: int):
+        """Удалить канал пользователя"""
+        async with self._write() as db:
+            await db.execute("DELETE FROM channels WHERE id = ? AND user_id = ?", (channel_db_id, user_id))
 
-    async def add_draft(self, user_id: int, channel_id: int, text: str, media: str, buttons: str):
-        """Добавить черновик"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Проверяем количество черновиков
-            async with db.execute(
-                "SELECT COUNT(*) FROM drafts WHERE user_id = ?",
-                (user_id,)
-            ) as cursor:
-                count = (await cursor.fetchone())[0]
-
-            # Если больше 5, удаляем самый старый
-            if count >= 5:
-                await db.execute("""
-                    DELETE FROM drafts WHERE id = (
-                        SELECT id FROM drafts WHERE user_id = ? 
-                        ORDER BY created_at ASC LIMIT 1
-                    )
-                """, (user_id,))
-
-            # Добавляем новый черновик
+    async def add_draft(self, user_id: int, channel_id: int, text: str, media: str, buttons: str,
+                        limit: int = DRAFTS_LIMIT) -> bool:
+        """Добавить черновик; True, если старейшие черновики сверх limit удалены"""
+        async with self._write() as db:
             await db.execute(
-                """INSERT INTO drafts (user_id, channel_id, text, media, buttons)
-                   VALUES (?, ?, ?, ?, ?)""",
-                (user_id, channel_id, text, media, buttons)
+                """INSERT INTO drafts (user_id, channel_id, text, media, buttons, media_count, buttons_count)
+                   VALUES (?, ?, ?, ?, ?, json_array_length(?), json_array_length(?))""",
+                (user_id, channel_id, text, media, buttons, media, buttons)
             )
-            await db.commit()
-            return count >= 5  # Возвращаем True если был удален старый черновик
-
-    async def get_user_drafts(self, user_id: int) -> List[Dict]:
-        """Получить черновики пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                """SELECT d.id, d.channel_id, d.text, d.media, d.buttons, d.created_at, c.channel_name
+            # Вытеснение одним запросом по индексу (user_id, created_at)
+            cursor = await db.execute(
+                """DELETE FROM drafts WHERE id IN (
+                       SELECT id FROM drafts WHERE user_id = ?
+                       ORDER BY created_at DESC, id DESC LIMIT -1 OFFSET ?
+                   )""",
+                (user_id, limit)
+            )
+            return cursor.rowcount > 0
+
+    async def get_user_drafts(self, user_id: int, after: Optional[tuple] = None,
+                              limit: int = DRAFTS_PAGE_SIZE) -> List[Dict]:
+        """Страница черновиков пользователя, от новых к старым.
+
+        after - (created_ts, id) последнего черновика предыдущей страницы:
+        сравниваем со значениями, а не ищем черновик по id, потому что его
+        могли удалить или вытеснить лимитом. Возвращается только превью
+        текста, поэтому стоимость страницы не зависит ни от числа
+        черновиков, ни от длины их текстов.
+        """
+        query = """SELECT d.id, d.channel_id, substr(d.text, 1, ?), length(d.text) > ?,
+                          d.media_count, d.buttons_count, d.created_at, c.channel_name,
+                          CAST(strftime('%s', d.created_at) AS INTEGER)
                    FROM drafts d
                    LEFT JOIN channels c ON d.channel_id = c.channel_id AND d.user_id = c.user_id
-                   WHERE d.user_id = ?
-                   ORDER BY d.created_at DESC""",
-                (user_id,)
-            ) as cursor:
+                   WHERE d.user_id = ?"""
+        params = [DRAFT_PREVIEW_LENGTH, DRAFT_PREVIEW_LENGTH, user_id]
+        if after is not None:
+            query += " AND (d.created_at, d.id) < (datetime(?, 'unixepoch'), ?)"
+            params += list(after)
+        query += " ORDER BY d.created_at DESC, d.id DESC LIMIT ?"
+        params.append(limit)
+
+        async with self._read() as db:
+            async with db.execute(query, params) as cursor:
                 rows = await cursor.fetchall()
                 return [
                     {
                         "id": row[0],
                         "channel_id": row[1],
-                        "text": row[2],
-                        "media": row[3],
-                        "buttons": row[4],
-                        "created_at": row[5],
-                        "channel_name": row[6] or "Неизвестный канал"
+                        "preview": row[2] + "..." if row[3] else row[2],
+                        "media_count": row[4],
+                        "buttons_count": row[5],
+                        "created_at": row[6],
+                        "channel_name": row[7] or "Неизвестный канал",
+                        "created_ts": row[8]
                     }
                     for row in rows
                 ]
 
     async def get_draft_by_id(self, draft_id: int) -> Optional[Dict]:
         """Получить черновик по ID"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(
-                """SELECT id, channel_id, text, media, buttons, created_at
-                   FROM drafts WHERE id = ?""",
+                """SELECT d.id, d.channel_id, d.text, d.media, d.buttons, d.created_at, c.channel_name
+                   FROM drafts d
+                   LEFT JOIN channels c ON d.channel_id = c.channel_id AND d.user_id = c.user_id
+                   WHERE d.id = ?""",
                 (draft_id,)
             ) as cursor:
                 row = await cursor.fetchone()
@@ -239,22 +872,2383 @@ class Database:
                         "text": row[2],
                         "media": row[3],
                         "buttons": row[4],
-                        "created_at": row[5]
+                        "created_at": row[5],
+                        "channel_name": row[6] or "Неизвестный канал"
                     }
                 return None
 
     async def delete_draft(self, draft_id: int):
         """Удалить черновик"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute("DELETE FROM drafts WHERE id = ?", (draft_id,))
-            await db.commit()
+
+    async def register_media(self, items: List[Dict]):
+        """Запомнить файлы, только что полученные от Telegram (их file_id заведомо рабочие)"""
+        now = time.time()
+        async with self._write() as db:
+            await db.executemany(
+                """INSERT INTO media (file_unique_id, file_id, type, file_size, valid, last_validated)
+                   VALUES (?, ?, ?, ?, 1, ?)
+                   ON CONFLICT(file_unique_id) DO UPDATE SET
+                       file_id = excluded.file_id,
+                       file_size = COALESCE(excluded.file_size, media.file_size),
+                       valid = 1,
+                       last_validated = excluded.last_validated""",
+                [(m["file_unique_id"], m["file_id"], m["type"], m.get("file_size"), now) for m in items]
+            )
+
+    async def get_media(self, file_unique_ids: List[str]) -> Dict[str, tuple]:
+        """{file_unique_id: (file_id, valid)} для известных файлов"""
+        placeholders = ",".join("?" * len(file_unique_ids))
+        async with self._read() as db:
+            async with db.execute(
+                f"SELECT file_unique_id, file_id, valid FROM media WHERE file_unique_id IN ({placeholders})",
+                file_unique_ids
+            ) as cursor:
+                return {row[0]: (row[1], bool(row[2])) for row in await cursor.fetchall()}
+
+    async def get_media_to_validate(self, until: datetime, stale_before: float, limit: int) -> List[tuple]:
+        """(file_unique_id, file_id) файлов постов, ожидающих публикации до until,
+        которые не проверялись с момента stale_before"""
+        async with self._read() as db:
+            async with db.execute(
+                """SELECT DISTINCT m.file_unique_id, m.file_id
+                   FROM scheduled_posts s, json_each(s.media) j
+                   JOIN media m ON m.file_unique_id = json_extract(j.value, '$.file_unique_id')
+                   WHERE s.status = 'pending' AND s.publish_time <= ? AND s.media IS NOT NULL
+                     AND m.valid = 1 AND (m.last_validated IS NULL OR m.last_validated < ?)
+                   LIMIT ?""",
+                (until.strftime(SCHEDULE_DB_FORMAT), stale_before, limit)
+            ) as cursor:
+                return await cursor.fetchall()
+
+    async def set_media_valid(self, file_unique_id: str, valid: bool):
+        """Записать результат проверки file_id"""
+        async with self._write() as db:
+            await db.execute(
+                "UPDATE media SET valid = ?, last_validated = ? WHERE file_unique_id = ?",
+                (int(valid), time.time(), file_unique_id)
+            )
+
+    async def get_scheduled_posts_with_media(self, file_unique_id: str) -> List[tuple]:
+        """(id, user_id, publish_time) ожидающих постов, в которых есть файл"""
+        async with self._read() as db:
+            async with db.execute(
+                """SELECT id, user_id, publish_time FROM scheduled_posts
+                   WHERE status = 'pending' AND media IS NOT NULL AND EXISTS (
+                       SELECT 1 FROM json_each(media) WHERE json_extract(value, '$.file_unique_id') = ?
+                   )""",
+                (file_unique_id,)
+            ) as cursor:
+                return await cursor.fetchall()
+
+    async def add_scheduled_post(self, user_id: int, channel_id: int, text: str, media: str, buttons: str,
+                                 publish_time: datetime) -> int:
+        """Добавить отложенный пост"""
+        async with self._write() as db:
+            cursor = await db.execute(
+                """INSERT INTO scheduled_posts (user_id, channel_id, text, media, buttons, publish_time)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (user_id, channel_id, text, media, buttons, publish_time.strftime(SCHEDULE_DB_FORMAT))
+            )
+            return cursor.lastrowid
+
+    async def get_pending_schedule(self) -> List[tuple]:
+        """Получить (id, publish_time) всех ожидающих постов"""
+        async with self._read() as db:
+            async with db.execute(
+                """SELECT id, publish_time FROM scheduled_posts
+                   WHERE status = 'pending' ORDER BY publish_time""",
+            ) as cursor:
+                rows = await cursor.fetchall()
+                return [(row[0], datetime.strptime(row[1], SCHEDULE_DB_FORMAT)) for row in rows]
+
+    async def claim_scheduled_posts(self, post_ids: List[int]) -> List[Dict]:
+        """Перевести посты из pending в sending и вернуть их.
+
+        Пост, уже забранный ранее, повторно не возвращается - это защищает
+        от двойной отправки.
+        """
+        if not post_ids:
+            return []
+        placeholders = ",".join("?" * len(post_ids))
+        async with self._write(immediate=True) as db:
+            async with db.execute(
+                f"""SELECT id, user_id, channel_id, text, media, buttons, publish_time
+                    FROM scheduled_posts WHERE id IN ({placeholders}) AND status = 'pending'""",
+                post_ids
+            ) as cursor:
+                rows = await cursor.fetchall()
+            await db.execute(
+                f"UPDATE scheduled_posts SET status = 'sending' WHERE id IN ({placeholders}) AND status = 'pending'",
+                post_ids
+            )
+            return [
+                {
+                    "id": row[0],
+                    "user_id": row[1],
+                    "channel_id": row[2],
+                    "text": row[3],
+                    "media": row[4],
+                    "buttons": row[5],
+                    "publish_time": datetime.strptime(row[6], SCHEDULE_DB_FORMAT)
+                }
+                for row in rows
+            ]
+
+    async def set_scheduled_status(self, post_id: int, status: str):
+        """Обновить статус отложенного поста"""
+        async with self._write() as db:
+            await db.execute("UPDATE scheduled_posts SET status = ? WHERE id = ?", (status, post_id))
+
+    async def recover_scheduled_posts(self) -> int:
+        """Вернуть в pending посты, застрявшие в sending; вернуть их число.
+
+        Пост уходит из sending в queued в одной транзакции с записью в
+        outbox (enqueue_outbox), поэтому пост в sending в канал точно не
+        отправлялся и его можно публиковать заново. Повторная постановка
+        в outbox защищена ключом scheduled:<id>.
+        """
+        async with self._write() as db:
+            cursor = await db.execute("UPDATE scheduled_posts SET status = 'pending' WHERE status = 'sending'")
+            return cursor.rowcount
+
+    async def get_fsm_record(self, key: str) -> Optional[tuple]:
+        """Получить (state, data, updated_at) FSM-сессии"""
+        async with self._read() as db:
+            async with db.execute(
+                "SELECT state, data, updated_at FROM fsm_storage WHERE key = ?",
+                (key,)
+            ) as cursor:
+                return await cursor.fetchone()
+
+    async def save_fsm_records(self, upserts: List[tuple], deletes: List[tuple]):
+        """Сохранить пачку FSM-сессий одной транзакцией"""
+        async with self._write() as db:
+            if upserts:
+                await db.executemany(
+                    """INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                       ON CONFLICT(key) DO UPDATE SET
+                           state = excluded.state, data = excluded.data, updated_at = excluded.updated_at""",
+                    upserts
+                )
+            if deletes:
+                await db.executemany("DELETE FROM fsm_storage WHERE key = ?", deletes)
+
+    async def delete_expired_fsm_records(self, before: float) -> int:
+        """Удалить FSM-сессии, не менявшиеся с before"""
+        async with self._write() as db:
+            cursor = await db.execute("DELETE FROM fsm_storage WHERE updated_at < ?", (before,))
+            return cursor.rowcount
+
+    async def create_broadcast(self, admin_id: int, from_chat_id: int, message_id: int, total: int) -> int:
+        """Создать запись о рассылке"""
+        async with self._write() as db:
+            cursor = await db.execute(
+                """INSERT INTO broadcasts (admin_id, from_chat_id, message_id, total)
+                   VALUES (?, ?, ?, ?)""",
+                (admin_id, from_chat_id, message_id, total)
+            )
+            return cursor.lastrowid
+
+    async def set_broadcast_status_message(self, broadcast_id: int, chat_id: int, message_id: int):
+        """Запомнить сообщение со статусом рассылки"""
+        async with self._write() as db:
+            await db.execute(
+                "UPDATE broadcasts SET status_chat_id = ?, status_message_id = ? WHERE id = ?",
+                (chat_id, message_id, broadcast_id)
+            )
+
+    async def save_broadcast_progress(self, broadcast_id: int, cursor: int, success: int, failed: int,
+                                      finished: bool = False):
+        """Сохранить прогресс рассылки"""
+        async with self._write() as db:
+            if finished:
+                await db.execute(
+                    """UPDATE broadcasts SET cursor = ?, success = ?, failed = ?,
+                              status = 'done', finished_at = CURRENT_TIMESTAMP
+                       WHERE id = ?""",
+                    (cursor, success, failed, broadcast_id)
+                )
+            else:
+                await db.execute(
+                    "UPDATE broadcasts SET cursor = ?, success = ?, failed = ? WHERE id = ?",
+                    (cursor, success, failed, broadcast_id)
+                )
+
+    _BROADCAST_COLUMNS = """id, admin_id, from_chat_id, message_id, status_chat_id, status_message_id,
+                            cursor, success, failed, total, status"""
+
+    @staticmethod
+    def _broadcast_row(row: tuple) -> Dict:
+        return {
+            "id": row[0],
+            "admin_id": row[1],
+            "from_chat_id": row[2],
+            "message_id": row[3],
+            "status_chat_id": row[4],
+            "status_message_id": row[5],
+            "cursor": row[6],
+            "success": row[7],
+            "failed": row[8],
+            "total": row[9],
+            "status": row[10]
+        }
+
+    async def get_unfinished_broadcasts(self) -> List[Dict]:
+        """Получить рассылки, прерванные до завершения"""
+        async with self._read() as db:
+            async with db.execute(
+                f"SELECT {self._BROADCAST_COLUMNS} FROM broadcasts WHERE status = 'running' ORDER BY id"
+            ) as cursor:
+                return [self._broadcast_row(row) for row in await cursor.fetchall()]
+
+    async def get_last_broadcast(self) -> Optional[Dict]:
+        """Получить последнюю рассылку"""
+        async with self._read() as db:
+            async with db.execute(
+                f"SELECT {self._BROADCAST_COLUMNS} FROM broadcasts ORDER BY id DESC LIMIT 1"
+            ) as cursor:
+                row = await cursor.fetchone()
+                return self._broadcast_row(row) if row else None
+
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """Взять или продлить аренду name; False, если она у другого процесса"""
+        now = time.time()
+        async with self._write(immediate=True) as db:
+            await db.execute(
+                """INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+                   ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+                   WHERE leases.holder = excluded.holder OR leases.expires_at < ?""",
+                (name, holder, now + ttl, now)
+            )
+            async with db.execute("SELECT holder FROM leases WHERE name = ?", (name,)) as cursor:
+                row = await cursor.fetchone()
+                return row is not None and row[0] == holder
+
+    async def release_lease(self, name: str, holder: str):
+        """Отпустить аренду, если она наша"""
+        async with self._write() as db:
+            await db.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+    async def enqueue_outbox(self, items: List[Dict]) -> int:
+        """Поставить публикации в outbox; вернуть, сколько из них поставлено.
+
+        Публикация с уже известным ключом идемпотентности пропускается, если
+        только она не в dead-letter: тогда её попытки начинаются заново с
+        того вызова, на котором она остановилась. Item со status = 'dead'
+        сразу попадает в отчёт как неудачный (например, бот не админ канала).
+        Отложенные посты из items переводятся в статус queued той же транзакцией.
+        """
+        now = time.time()
+        queued = 0
+        async with self._write() as db:
+            for item in items:
+                cursor = await db.execute(
+                    """INSERT INTO outbox (idempotency_key, batch, user_id, chat_id, channel_name, text, media,
+                                           buttons, draft_id, scheduled_post_id, report_chat_id,
+                                           report_message_id, next_attempt_at, status, last_error,
+                                           finished_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT(idempotency_key) DO UPDATE SET
+                           status = 'pending', attempts = 0, last_error = NULL, finished_at = NULL,
+                           next_attempt_at = excluded.next_attempt_at,
+                           report_chat_id = excluded.report_chat_id,
+                           report_message_id = excluded.report_message_id
+                       WHERE outbox.status = 'dead'""",
+                    (item["key"], item.get("batch", item["key"]), item["user_id"], item["chat_id"],
+                     item.get("channel_name"), item["text"], item["media"], item["buttons"],
+                     item.get("draft_id"), item.get("scheduled_post_id"), item.get("report_chat_id"),
+                     item.get("report_message_id"), now, item.get("status", "pending"),
+                     item.get("last_error"), now if item.get("status") == "dead" else None)
+                )
+                queued += cursor.rowcount
+            scheduled = [(item["scheduled_post_id"],) for item in items if item.get("scheduled_post_id")]
+            if scheduled:
+                await db.executemany("UPDATE scheduled_posts SET status = 'queued' WHERE id = ?", scheduled)
+        return queued
+
+    _OUTBOX_COLUMNS = """id, batch, user_id, chat_id, channel_name, text, media, buttons, draft_id,
+                         scheduled_post_id, report_chat_id, report_message_id, status, attempts,
+                         progress, last_error"""
+
+    @staticmethod
+    def _outbox_row(row: tuple) -> Dict:
+        return {
+            "id": row[0],
+            "batch": row[1],
+            "user_id": row[2],
+            "chat_id": row[3],
+            "channel_name": row[4],
+            "text": row[5],
+            "media": row[6],
+            "buttons": row[7],
+            "draft_id": row[8],
+            "scheduled_post_id": row[9],
+            "report_chat_id": row[10],
+            "report_message_id": row[11],
+            "status": row[12],
+            "attempts": row[13],
+            "progress": row[14],
+            "last_error": row[15]
+        }
+
+    async def claim_outbox(self, now: float, limit: int) -> List[Dict]:
+        """Забрать созревшие публикации: pending -> sending, attempts + 1"""
+        async with self._write(immediate=True) as db:
+            async with db.execute(
+                f"""SELECT {self._OUTBOX_COLUMNS} FROM outbox
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at LIMIT ?""",
+                (now, limit)
+            ) as cursor:
+                rows = [self._outbox_row(row) for row in await cursor.fetchall()]
+            await db.executemany(
+                "UPDATE outbox SET status = 'sending', attempts = attempts + 1 WHERE id = ?",
+                [(row["id"],) for row in rows]
+            )
+        for row in rows:
+            row["status"] = "sending"
+            row["attempts"] += 1
+        return rows
+
+    async def get_next_outbox_attempt(self) -> Optional[float]:
+        """Время ближайшей попытки среди ожидающих публикаций"""
+        async with self._read() as db:
+            async with db.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'") as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def get_outbox_sending(self) -> List[Dict]:
+        """Публикации, прерванные во время отправки"""
+        async with self._read() as db:
+            async with db.execute(
+                f"SELECT {self._OUTBOX_COLUMNS} FROM outbox WHERE status = 'sending'"
+            ) as cursor:
+                return [self._outbox_row(row) for row in await cursor.fetchall()]
+
+    async def set_outbox_progress(self, outbox_id: int, progress: int):
+        """Запомнить, сколько вызовов SendPlan уже отправлено"""
+        async with self._write() as db:
+            await db.execute("UPDATE outbox SET progress = ? WHERE id = ?", (progress, outbox_id))
+
+    async def retry_outbox(self, outbox_id: int, next_attempt_at: float, error: str):
+        """Вернуть публикацию в очередь до next_attempt_at"""
+        async with self._write() as db:
+            await db.execute(
+                "UPDATE outbox SET status = 'pending', next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (next_attempt_at, error, outbox_id)
+            )
+
+    async def finish_outbox(self, outbox_id: int, status: str, error: Optional[str] = None) -> Optional[List[Dict]]:
+        """Завершить публикацию (sent или dead).
+
+        Доставленный черновик удаляется, у отложенного поста выставляется
+        итоговый статус. Если это была последняя незавершённая публикация
+        своего batch, возвращаются все строки batch для отчёта, иначе None.
+        """
+        async with self._write(immediate=True) as db:
+            async with db.execute(
+                "SELECT batch, draft_id, scheduled_post_id FROM outbox WHERE id = ?", (outbox_id,)
+            ) as cursor:
+                batch, draft_id, scheduled_post_id = await cursor.fetchone()
+            await db.execute(
+                "UPDATE outbox SET status = ?, last_error = ?, finished_at = ? WHERE id = ?",
+                (status, error, time.time(), outbox_id)
+            )
+            if status == "sent" and draft_id:
+                await db.execute("DELETE FROM drafts WHERE id = ?", (draft_id,))
+            if scheduled_post_id:
+                await db.execute(
+                    "UPDATE scheduled_posts SET status = ? WHERE id = ?",
+                    ("sent" if status == "sent" else "failed", scheduled_post_id)
+                )
+            async with db.execute(
+                f"SELECT {self._OUTBOX_COLUMNS} FROM outbox WHERE batch = ? ORDER BY id", (batch,)
+            ) as cursor:
+                rows = [self._outbox_row(row) for row in await cursor.fetchall()]
+        if any(row["status"] in ("pending", "sending") for row in rows):
+            return None
+        return rows
+
+    async def delete_finished_outbox(self, before: float) -> int:
+        """Удалить завершённые до before публикации"""
+        async with self._write() as db:
+            cursor = await db.execute(
+                "DELETE FROM outbox WHERE status IN ('sent', 'dead') AND finished_at < ?", (before,)
+            )
+            return cursor.rowcount
+
+instrument(Database, DB_LATENCY)
+
+# ==================== КЭШ КАНАЛОВ ====================
+class TTLCache:
+    """LRU-кэш с ограничением размера и временем жизни записей"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+
+class ChannelCache:
+    """Каналы пользователей в памяти.
+
+    Для каждого user_id хранится список каналов, индекс по id строки и
+    уже собранные клавиатуры; add_channel/delete_channel сбрасывают запись.
+    """
+
+    def __init__(self, database: Database, maxsize: int = CHANNEL_CACHE_SIZE, ttl: float = CHANNEL_CACHE_TTL):
+        self.db = database
+        self._entries = TTLCache(maxsize, ttl)
+
+    async def _entry(self, user_id: int) -> dict:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            channels = await self.db.get_user_channels(user_id)
+            entry = {
+                "channels": channels,
+                "by_id": {ch["id"]: ch for ch in channels},
+                "keyboards": {}
+            }
+            self._entries.set(user_id, entry)
+        return entry
+
+    async def get_channels(self, user_id: int) -> List[Dict]:
+        """Каналы пользователя (список не изменять)"""
+        return (await self._entry(user_id))["channels"]
+
+    async def get_channel(self, user_id: int, channel_db_id: int) -> Optional[Dict]:
+        """Канал пользователя по id строки"""
+        return (await self._entry(user_id))["by_id"].get(channel_db_id)
+
+    async def keyboard(self, user_id: int, key: tuple, build) -> InlineKeyboardMarkup:
+        """Клавиатура из кэша или build(channels)"""
+        entry = await self._entry(user_id)
+        markup = entry["keyboards"].get(key)
+        if markup is None:
+            if len(entry["keyboards"]) >= KEYBOARD_CACHE_SIZE:
+                entry["keyboards"].clear()
+            markup = build(entry["channels"])
+            entry["keyboards"][key] = markup
+        return markup
+
+    def invalidate(self, user_id: int):
+        """Сбросить кэш пользователя"""
+        self._entries.pop(user_id)
+
+
+class TelegramMetadata:
+    """Кэш метаданных Telegram: профиль бота, чаты и участники чатов.
+
+    Профиль бота запрашивается один раз при старте. get_chat и
+    get_chat_member хранятся METADATA_CACHE_TTL секунд; одновременные
+    запросы одного ключа ждут один общий вызов API, ошибки не кэшируются.
+    Права бота в каналах обновляются апдейтами my_chat_member.
+    """
+
+    def __init__(self, maxsize: int = METADATA_CACHE_SIZE, ttl: float = METADATA_CACHE_TTL):
+        self.me: Optional[User] = None
+        self._chats = TTLCache(maxsize, ttl)
+        self._members = TTLCache(maxsize, ttl)
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+
+    async def start(self):
+        """Получить профиль бота"""
+        self.me = await bot.get_me()
+
+    async def get_me(self) -> User:
+        if self.me is None:
+            self.me = await self._single(("me",), bot.get_me)
+        return self.me
+
+    async def get_chat(self, chat_id: Any) -> Chat:
+        """Чат по id или @username"""
+        key = chat_id.lower() if isinstance(chat_id, str) else chat_id
+        chat = await self._cached("chat", self._chats, key, lambda: bot.get_chat(chat_id))
+        self._chats.set(chat.id, chat)
+        return chat
+
+    async def get_chat_member(self, chat_id: int, user_id: int, fresh: bool = False):
+        """Участник чата; fresh - мимо кэша, с обновлением кэша"""
+        return await self._cached(
+            "chat_member", self._members, (chat_id, user_id),
+            lambda: bot.get_chat_member(chat_id, user_id), fresh
+        )
+
+    def set_chat_member(self, chat_id: int, user_id: int, member):
+        """Запомнить участника из апдейта (my_chat_member)"""
+        self._members.set((chat_id, user_id), member)
+
+    def invalidate_chat(self, chat_id: int):
+        self._chats.pop(chat_id)
+
+    async def _cached(self, kind: str, cache: TTLCache, key: Any, fetch, fresh: bool = False):
+        if not fresh:
+            value = cache.get(key)
+            if value is not None:
+                METADATA_LOOKUPS.inc(kind, "hit")
+                return value
+        value = await self._single((kind, key), fetch, kind)
+        cache.set(key, value)
+        return value
+
+    async def _single(self, key: tuple, fetch, kind: str = "me"):
+        """Один вызов fetch на ключ, сколько бы запросов ни пришло одновременно"""
+        task = self._inflight.get(key)
+        if task is None:
+            METADATA_LOOKUPS.inc(kind, "miss")
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            METADATA_LOOKUPS.inc(kind, "coalesced")
+        # shield: отмена одного ожидающего не отменяет запрос для остальных
+        return await asyncio.shield(task)
+
+
+def lost_channel_access(error: Exception) -> bool:
+    """Ошибка Telegram означает, что бот больше не может писать в канал"""
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    message = str(error).lower()
+    return isinstance(error, TelegramBadRequest) and any(
+        reason in message for reason in ("not enough rights", "administrator rights", "chat not found")
+    )
+
+
+class ChannelMonitor:
+    """Права бота в каналах пользователей.
+
+    Основной источник - апдейты my_chat_member, которые Telegram шлёт при
+    назначении, снятии прав или удалении бота. Пропущенные изменения
+    (бот был выключен) находит фоновая перепроверка: раз в
+    CHANNEL_RECHECK_INTERVAL каждый канал проверяется через
+    get_chat_member, порциями по CHANNEL_RECHECK_BATCH и не больше
+    CHANNEL_RECHECK_CONCURRENCY запросов одновременно.
+    """
+
+    def __init__(self, database: Database, cache: ChannelCache):
+        self.db = database
+        self.cache = cache
+        self._task: Optional[asyncio.Task] = None
+
+    async def set_admin(self, channel_id: int, is_admin: Optional[bool], channel_name: Optional[str] = None):
+        """Записать права бота в канале и сбросить кэш его владельцев"""
+        changed = await self.db.set_channel_admin(channel_id, is_admin, channel_name)
+        for user_id in changed:
+            self.cache.invalidate(user_id)
+        if changed:
+            logger.info(f"Channel {channel_id}: bot is_admin={is_admin} for {len(changed)} users")
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Channel recheck failed: {e}")
+            await asyncio.sleep(CHANNEL_RECHECK_POLL)
+
+    async def reconcile(self):
+        """Перепроверить каналы, не проверявшиеся дольше CHANNEL_RECHECK_INTERVAL"""
+        before = time.time() - CHANNEL_RECHECK_INTERVAL
+        slots = asyncio.Semaphore(CHANNEL_RECHECK_CONCURRENCY)
+
+        async def check(channel_id: int):
+            async with slots:
+                await self._check(channel_id)
+
+        while channel_ids := await self.db.get_channels_to_check(before, CHANNEL_RECHECK_BATCH):
+            await asyncio.gather(*(check(channel_id) for channel_id in channel_ids))
+
+    async def _check(self, channel_id: int):
+        try:
+            member = await metadata.get_chat_member(channel_id, bot.id, fresh=True)
+            is_admin = member.status in ("administrator", "creator")
+        except Exception as e:
+            if lost_channel_access(e):
+                is_admin = False
+            else:
+                # Временная ошибка: статус не трогаем, проверим в следующий раз
+                logger.warning(f"Channel {channel_id} recheck failed: {e}")
+                is_admin = None
+        await self.set_admin(channel_id, is_admin)
+
+# ==================== ХРАНИЛИЩЕ FSM ====================
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в той же SQLite базе.
+
+    Записи кэшируются в памяти (LRU на FSM_CACHE_SIZE ключей), а изменения
+    копятся и пишутся одной транзакцией раз в FSM_FLUSH_INTERVAL секунд,
+    поэтому update_data не стоит fsync. Сессии, не менявшиеся дольше
+    FSM_SESSION_TTL, удаляются фоновой очисткой.
+    """
+
+    def __init__(self, database: Database, cache_size: int = FSM_CACHE_SIZE):
+        self.db = database
+        self.cache_size = cache_size
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # key -> [state, data, updated_at]
+        self._cache: "OrderedDict[str, list]" = OrderedDict()
+        self._dirty: set = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._cleanup_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Запустить фоновые запись и очистку"""
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def close(self):
+        """Остановить фоновые задачи и записать накопленное"""
+        for task in (self._flush_task, self._cleanup_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._flush_task = self._cleanup_task = None
+        await self.flush()
+
+    async def _record(self, key: StorageKey) -> list:
+        storage_key = self.key_builder.build(key)
+        record = self._cache.get(storage_key)
+        if record is None:
+            row = await self.db.get_fsm_record(storage_key)
+            # Пока ждали БД, запись мог создать параллельный апдейт
+            record = self._cache.get(storage_key)
+            if record is None:
+                if row:
+                    record = [row[0], json.loads(row[1]) if row[1] else {}, row[2]]
+                else:
+                    record = [None, {}, time.time()]
+                self._cache[storage_key] = record
+                self._evict(keep=storage_key)
+        self._cache.move_to_end(storage_key)
+        return record
+
+    def _touch(self, key: StorageKey, record: list):
+        record[2] = time.time()
+        self._dirty.add(self.key_builder.build(key))
+
+    def _evict(self, keep: Optional[str] = None):
+        """Вытеснить самые старые записи, уже сохранённые в БД"""
+        if len(self._cache) <= self.cache_size:
+            return
+        for storage_key in list(self._cache):
+            if len(self._cache) <= self.cache_size:
+                break
+            if storage_key not in self._dirty and storage_key != keep:
+                del self._cache[storage_key]
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        self._touch(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._record(key)
+        record[1] = data.copy()
+        self._touch(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._record(key))[1].copy()
+
+    async def flush(self):
+        """Записать все изменённые сессии одной транзакцией"""
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        upserts = []
+        deletes = []
+        for storage_key in keys:
+            record = self._cache.get(storage_key)
+            if record is None:
+                continue
+            state, data, updated_at = record
+            if state is None and not data:
+                deletes.append((storage_key,))
+            else:
+                upserts.append((
+                    storage_key,
+                    state,
+                    json.dumps(data, ensure_ascii=False, separators=(",", ":")) if data else None,
+                    updated_at
+                ))
+        try:
+            await self.db.save_fsm_records(upserts, deletes)
+        except asyncio.CancelledError:
+            self._dirty |= keys
+            raise
+        except Exception as e:
+            logger.error(f"FSM flush failed, will retry: {e}")
+            self._dirty |= keys
+            return
+
+        for (storage_key,) in deletes:
+            record = self._cache.get(storage_key)
+            # Сессию могли снова начать, пока шла запись
+            if record is not None and record[0] is None and not record[1] and storage_key not in self._dirty:
+                del self._cache[storage_key]
+        self._evict()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(FSM_FLUSH_INTERVAL)
+            await self.flush()
+
+    async def _cleanup_loop(self):
+        while True:
+            expire_before = time.time() - FSM_SESSION_TTL
+            for storage_key in [k for k, r in self._cache.items() if r[2] < expire_before and k not in self._dirty]:
+                del self._cache[storage_key]
+            try:
+                removed = await self.db.delete_expired_fsm_records(expire_before)
+                if removed:
+                    logger.info(f"Removed {removed} abandoned FSM sessions")
+            except Exception as e:
+                logger.error(f"FSM cleanup failed: {e}")
+            await asyncio.sleep(FSM_CLEANUP_INTERVAL)
+
+# ==================== РЕЕСТР ПОЛЬЗОВАТЕЛЕЙ ====================
+class BloomFilter:
+    """Bloom-фильтр по целым ключам: отвечает "точно нет" или "возможно есть" """
+
+    def __init__(self, capacity: int, error_rate: float = USERS_BLOOM_ERROR_RATE):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: int):
+        digest = hashlib.blake2b(key.to_bytes(8, "little", signed=True), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: int):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: int) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class UserRegistry:
+    """Регистрация пользователей и их активности без записи на каждый апдейт.
+
+    Bloom-фильтр содержит всех зарегистрированных (нажимавших /start)
+    пользователей и отсекает чужих без запроса к БД, а LRU-кэш на
+    USERS_CACHE_SIZE записей помнит username и время последней записи
+    last_seen. Запись нужна только новому пользователю, при смене
+    username или раз в USERS_SEEN_INTERVAL; такие изменения копятся и
+    пишутся одной транзакцией раз в USERS_FLUSH_INTERVAL секунд.
+    """
+
+    def __init__(self, database: Database, cache_size: int = USERS_CACHE_SIZE):
+        self.db = database
+        self.cache_size = cache_size
+        self.bloom = BloomFilter(USERS_BLOOM_CAPACITY)
+        # user_id -> [username, last_seen, есть ли строка в БД точно]
+        self._cache: "OrderedDict[int, list]" = OrderedDict()
+        # user_id -> (username, last_seen, register)
+        self._pending: Dict[int, tuple] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Заполнить bloom-фильтр из БД и запустить фоновую запись"""
+        total = await self.db.count_users()
+        if total * 2 > USERS_BLOOM_CAPACITY:
+            self.bloom = BloomFilter(total * 2)
+        async for user_id in self.db.iter_users():
+            self.bloom.add(user_id)
+        logger.info(f"User registry loaded {total} users")
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Остановить фоновую запись и записать накопленное"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+    def seen(self, user_id: int, username: Optional[str], register: bool = False):
+        """Отметить активность пользователя; register - он нажал /start"""
+        now = time.time()
+        entry = self._cache.get(user_id)
+        if entry is not None:
+            self._cache.move_to_end(user_id)
+            if entry[0] == username and now - entry[1] < USERS_SEEN_INTERVAL and (entry[2] or not register):
+                return
+        elif not register and user_id not in self.bloom:
+            return  # Не регистрировался: активность не пишем
+
+        pending = self._pending.get(user_id)
+        register = register or (pending is not None and pending[2])
+        self._pending[user_id] = (username, now, register)
+        if register:
+            self.bloom.add(user_id)
+        # Без register строки может не быть (ложное срабатывание фильтра)
+        self._cache[user_id] = [username, now, register or (entry is not None and entry[2])]
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def flush(self):
+        """Записать накопленные изменения одной транзакцией"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        inserts = [(user_id, username, seen) for user_id, (username, seen, register) in pending.items() if register]
+        updates = [(username, seen, user_id) for user_id, (username, seen, register) in pending.items() if not register]
+        try:
+            await self.db.save_users(inserts, updates)
+        except asyncio.CancelledError:
+            self._restore(pending)
+            raise
+        except Exception as e:
+            logger.error(f"User registry flush failed, will retry: {e}")
+            self._restore(pending)
+
+    def _restore(self, pending: Dict[int, tuple]):
+        # Более свежие отметки, пришедшие во время записи, важнее
+        for user_id, value in pending.items():
+            newer = self._pending.get(user_id)
+            if newer is None:
+                self._pending[user_id] = value
+            elif value[2] and not newer[2]:
+                self._pending[user_id] = (newer[0], newer[1], True)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(USERS_FLUSH_INTERVAL)
+            await self.flush()
+
+# ==================== ЛИМИТЫ TELEGRAM ====================
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, запас до capacity.
+
+    Ожидающие обслуживаются по приоритету (меньше - раньше), при равном
+    приоритете - в порядке очереди.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: list = []  # куча (priority, seq, future)
+        self._seq = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def pause(self, seconds: float):
+        """Остановить выдачу токенов (например, после RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, priority: int = 0):
+        """Дождаться и забрать один токен"""
+        if not self._waiters and self._take():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    def _take(self) -> bool:
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def _dispatch(self):
+        """Раздавать токены ожидающим, пока очередь не опустеет"""
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():
+                heapq.heappop(self._waiters)  # Ожидающий отменён
+            elif self._take():
+                heapq.heappop(self._waiters)
+                future.set_result(None)
+            else:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                else:
+                    await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChatRateLimiter:
+    """Лимит на чат: в среднем одно сообщение в interval секунд, подряд до burst"""
+
+    def __init__(self, interval: float, burst: int = 1, max_chats: int = 10000):
+        self.interval = interval
+        self.burst = burst
+        self.max_chats = max_chats
+        self._next_slot: Dict[Any, float] = {}
+        self._paused_until: Dict[Any, float] = {}
+
+    def pause(self, chat_id: Any, seconds: float):
+        """Не отправлять в чат ближайшие seconds секунд"""
+        until = time.monotonic() + seconds
+        self._paused_until[chat_id] = max(self._paused_until.get(chat_id, 0.0), until)
+
+    async def wait_pause(self, chat_id: Any):
+        """Дождаться конца паузы чата, не занимая слот"""
+        until = self._paused_until.get(chat_id)
+        if until is None:
+            return
+        delay = until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            self._paused_until.pop(chat_id, None)
+
+    async def acquire(self, chat_id: Any):
+        """Дождаться своего слота для чата"""
+        now = time.monotonic()
+        slot = max(now - (self.burst - 1) * self.interval, self._next_slot.get(chat_id, 0.0),
+                   self._paused_until.get(chat_id, 0.0))
+        self._next_slot[chat_id] = slot + self.interval
+
+        if len(self._next_slot) > self.max_chats:
+            self._next_slot = {k: v for k, v in self._next_slot.items() if v > now}
+            self._paused_until = {k: v for k, v in self._paused_until.items() if v > now}
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+# Полосы приоритета исходящих запросов: ответы пользователям идут раньше
+# публикаций, публикации - раньше массовой рассылки
+LANE_INTERACTIVE, LANE_PUBLISH, LANE_BULK = range(3)
+LANE_NAMES = ("interactive", "publish", "bulk")
+outbound_lane: ContextVar[int] = ContextVar("outbound_lane", default=LANE_INTERACTIVE)
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Общий слой лимитов для всех исходящих сообщений бота.
+
+    Стоит в сессии Bot, поэтому через него проходят и хендлеры, и
+    публикации, и рассылка. Отправка в чат ждёт слот лимита этого чата,
+    затем токен общего лимита бота по полосе из outbound_lane. Ответы
+    пользователям в личке и правки сообщений слот чата не занимают - их темп
+    задаёт сам пользователь. RetryAfter ставит на паузу только свой чат и
+    повторяет запрос; общая скорость снижается вдвое (не ниже
+    OUTBOUND_MIN_RATE), только если RetryAfter пришёл сразу в нескольких
+    чатах. Без новых RetryAfter скорость постепенно возвращается к исходной.
+    """
+
+    LIMITED = ("send", "copy", "forward", "edit")
+    PER_CHAT = ("send", "copy", "forward")
+
+    def __init__(self, rate: float):
+        self.max_rate = rate
+        self.bucket = TokenBucket(rate)
+        self.private_limiter = ChatRateLimiter(TELEGRAM_CHAT_INTERVAL, TELEGRAM_CHAT_BURST)
+        self.group_limiter = ChatRateLimiter(TELEGRAM_GROUP_INTERVAL, TELEGRAM_CHAT_BURST)
+        self._waiting = [0] * len(LANE_NAMES)
+        self._floods: Dict[Any, float] = {}  # чат -> время последнего RetryAfter
+        self._last_change = time.monotonic()
+        OUTBOUND_RATE.set(rate)
+        for name in LANE_NAMES:
+            OUTBOUND_QUEUE.set(0, name)
+
+    def set_rate_limit(self, rate: float):
+        """Сменить целевую скорость (например, в бенчмарках)"""
+        self.max_rate = self.bucket.rate = self.bucket.capacity = rate
+        OUTBOUND_RATE.set(rate)
+
+    def chat_limiter(self, chat_id: Any) -> ChatRateLimiter:
+        # Отрицательные id и @username - группы и каналы
+        if isinstance(chat_id, int) and chat_id > 0:
+            return self.private_limiter
+        return self.group_limiter
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = method.__api_method__
+        if not name.startswith(self.LIMITED):
+            return await make_request(bot, method)
+
+        lane = outbound_lane.get()
+        chat_id = getattr(method, "chat_id", None)
+        per_chat = (chat_id is not None and name.startswith(self.PER_CHAT)
+                    and not (lane == LANE_INTERACTIVE and self.chat_limiter(chat_id) is self.private_limiter))
+        for attempt in range(OUTBOUND_RETRIES + 1):
+            await self._wait(lane, chat_id, per_chat)
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                OUTBOUND_FLOODS.inc(name, LANE_NAMES[lane])
+                self._slow_down(chat_id, e.retry_after)
+                if attempt == OUTBOUND_RETRIES or e.retry_after > OUTBOUND_MAX_RETRY_WAIT:
+                    raise
+                logger.warning(f"{name} to {chat_id}: flood control, retry in {e.retry_after}s")
+                continue
+            self._recover()
+            return result
+
+    async def _wait(self, lane: int, chat_id: Any, per_chat: bool):
+        self._waiting[lane] += 1
+        OUTBOUND_QUEUE.set(self._waiting[lane], LANE_NAMES[lane])
+        try:
+            if per_chat:
+                await self.chat_limiter(chat_id).acquire(chat_id)
+            elif chat_id is not None:
+                await self.chat_limiter(chat_id).wait_pause(chat_id)
+            await self.bucket.acquire(lane)
+        finally:
+            self._waiting[lane] -= 1
+            OUTBOUND_QUEUE.set(self._waiting[lane], LANE_NAMES[lane])
+
+    def _slow_down(self, chat_id: Any, retry_after: float):
+        if chat_id is not None:
+            self.chat_limiter(chat_id).pause(chat_id, retry_after)
+        # RetryAfter в одном чате - лимит этого чата; сразу в нескольких - общий лимит бота
+        now = time.monotonic()
+        self._floods = {chat: at for chat, at in self._floods.items() if now - at < OUTBOUND_RECOVERY_INTERVAL}
+        self._floods[chat_id] = now
+        if chat_id is None or len(self._floods) >= OUTBOUND_GLOBAL_FLOOD_CHATS:
+            self._floods.clear()
+            self.bucket.pause(retry_after)
+            self._set_rate(max(OUTBOUND_MIN_RATE, self.bucket.rate / 2))
+
+    def _recover(self):
+        if self.bucket.rate < self.max_rate and time.monotonic() - self._last_change >= OUTBOUND_RECOVERY_INTERVAL:
+            self._set_rate(min(self.max_rate, self.bucket.rate + self.max_rate / 10))
+
+    def _set_rate(self, rate: float):
+        if rate != self.bucket.rate:
+            logger.info(f"Outbound rate {self.bucket.rate:.1f} -> {rate:.1f} msg/s")
+        self.bucket.rate = rate
+        self._last_change = time.monotonic()
+        OUTBOUND_RATE.set(rate)
+
+
+def outbound_rate(leader: bool, workers: int = WORKERS) -> float:
+    """Доля TELEGRAM_GLOBAL_RATE для процесса.
+
+    Публикации и рассылки идут только с лидера, остальные воркеры лишь
+    отвечают пользователям: им вместе OUTBOUND_FOLLOWER_SHARE лимита,
+    лидеру - всё остальное, сколько бы ни было воркеров.
+    """
+    if workers <= 1:
+        return TELEGRAM_GLOBAL_RATE
+    followers = TELEGRAM_GLOBAL_RATE * OUTBOUND_FOLLOWER_SHARE
+    return TELEGRAM_GLOBAL_RATE - followers if leader else followers / (workers - 1)
+
+# ==================== РЕНДЕР ПОСТОВ ====================
+class SendPlan:
+    """Готовый список вызовов Bot API для одного поста.
+
+    План не зависит от чата: один и тот же объект отправляет предпросмотр,
+    публикацию и отложенный пост в любой chat_id.
+    """
+
+    __slots__ = ("calls",)
+
+    def __init__(self, calls: tuple):
+        self.calls = calls  # ((имя метода Bot, MappingProxyType(аргументы)), ...)
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    async def send(self, chat_id: int, start: int = 0,
+                   on_sent: Optional[Callable[[int], Awaitable[None]]] = None):
+        """Выполнить план в чат chat_id, начиная с вызова start.
+
+        Лимиты и повторы после RetryAfter делает OutboundLimiter на уровне
+        отдельного вызова, поэтому уже отправленные части поста не дублируются.
+        on_sent(n) ожидается после каждого вызова с числом выполненных вызовов.
+        """
+        for index in range(start, len(self.calls)):
+            method, kwargs = self.calls[index]
+            await getattr(bot, method)(chat_id=chat_id, **kwargs)
+            if on_sent:
+                await on_sent(index + 1)
+
+
+class PostRenderer:
+    """Компиляция поста (текст, медиа, кнопки) в SendPlan.
+
+    Результат кэшируется по содержимому поста, так что клавиатура и
+    InputMedia строятся один раз на пост, а не на каждую отправку. Кэш у
+    каждого экземпляра свой: lru_cache на методе класса был бы общим для
+    всех рендереров и держал бы их в ключах навсегда.
+    """
+
+    _INPUT_MEDIA = {"photo": InputMediaPhoto, "video": InputMediaVideo}
+    _SINGLE = {
+        "photo": ("send_photo", "photo"),
+        "video": ("send_video", "video"),
+        "animation": ("send_animation", "animation"),
+    }
+
+    def __init__(self, cache_size: int = RENDER_CACHE_SIZE):
+        self._compile = lru_cache(maxsize=cache_size)(self._build)
+
+    def compile(self, text: str, media: List[Dict], buttons: List[Dict]) -> SendPlan:
+        """Собрать план для поста"""
+        return self._compile(
+            text or "",
+            tuple((m["type"], m["file_id"]) for m in media),
+            tuple((btn["text"], btn["url"]) for btn in buttons)
+        )
+
+    @staticmethod
+    def keyboard(buttons: tuple) -> Optional[InlineKeyboardMarkup]:
+        """Клавиатура поста: по кнопке в ряд"""
+        if not buttons:
+            return None
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=text, url=url)] for text, url in buttons
+        ])
+
+    def _build(self, text: str, media: tuple, buttons: tuple) -> SendPlan:
+        keyboard = self.keyboard(buttons)
+        calls = []
+
+        if not media:
+            calls.append(("send_message", {"text": text, "reply_markup": keyboard}))
+            return self._freeze(calls)
+
+        # Подпись у медиа ограничена, длинный текст уходит отдельным сообщением
+        caption = text if text and len(text) <= CAPTION_LIMIT else None
+        text_after = text if text and caption is None else None
+
+        # В альбом Telegram принимает только фото и видео; GIF идут отдельно
+        grouped = [m for m in media if m[0] in self._INPUT_MEDIA]
+        animations = [m for m in media if m[0] not in self._INPUT_MEDIA]
+
+        if len(grouped) > 1:
+            calls.append(("send_media_group", {"media": [
+                self._INPUT_MEDIA[media_type](media=file_id, caption=caption if i == 0 else None)
+                for i, (media_type, file_id) in enumerate(grouped)
+            ]}))
+            caption = None
+            singles = animations
+        else:
+            singles = grouped + animations
+
+        for media_type, file_id in singles:
+            method, field = self._SINGLE[media_type]
+            calls.append((method, {field: file_id, "caption": caption}))
+            caption = None
+
+        if text_after:
+            calls.append(("send_message", {"text": text_after}))
+
+        if keyboard:
+            method, kwargs = calls[-1]
+            if method == "send_media_group":
+                # К альбому нельзя прикрепить клавиатуру
+                calls.append(("send_message", {"text": "👆 Кнопки к посту:", "reply_markup": keyboard}))
+            else:
+                calls[-1] = (method, {**kwargs, "reply_markup": keyboard})
+
+        return self._freeze(calls)
+
+    @staticmethod
+    def _freeze(calls: list) -> SendPlan:
+        return SendPlan(tuple((method, MappingProxyType(kwargs)) for method, kwargs in calls))
+
+# ==================== МЕДИА ====================
+def media_json(media: List[Dict]) -> str:
+    """JSON медиа для черновиков и отложенных постов"""
+    return json.dumps([
+        {key: m[key] for key in ("type", "file_id", "file_unique_id") if m.get(key)}
+        for m in media
+    ])
+
+
+class MediaRegistry:
+    """Реестр файлов по file_unique_id и фоновая проверка их file_id.
+
+    Перед публикацией file_id подменяются последними известными, а файлы,
+    которые Telegram больше не отдаёт, выбрасываются из поста. Файлы
+    отложенных постов проверяются через get_file заранее, за
+    MEDIA_VALIDATE_AHEAD секунд до публикации, и автор узнаёт о битом
+    файле до срока, а не по ошибке отправки.
+    """
+
+    def __init__(self, database: Database, interval: float = MEDIA_CHECK_INTERVAL):
+        self.db = database
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def register(self, items: List[Dict]):
+        items = [m for m in items if m.get("file_unique_id")]
+        if items:
+            await self.db.register_media(items)
+
+    async def resolve(self, media: List[Dict]) -> tuple:
+        """(медиа с актуальными file_id, сколько файлов выброшено как недоступные)"""
+        unique_ids = [m["file_unique_id"] for m in media if m.get("file_unique_id")]
+        if not unique_ids:
+            return media, 0
+        known = await self.db.get_media(unique_ids)
+        resolved, dropped = [], 0
+        for m in media:
+            entry = known.get(m.get("file_unique_id"))
+            if entry is None:
+                resolved.append(m)
+            elif entry[1]:
+                resolved.append({**m, "file_id": entry[0]})
+            else:
+                dropped += 1
+        return resolved, dropped
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.validate_upcoming()
+            except Exception as e:
+                logger.error(f"Media validation failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def validate_upcoming(self):
+        """Проверить файлы постов, которые скоро публикуются"""
+        pending = await self.db.get_media_to_validate(
+            datetime.now() + timedelta(seconds=MEDIA_VALIDATE_AHEAD),
+            time.time() - MEDIA_VALIDATION_TTL,
+            MEDIA_CHECK_BATCH
+        )
+        for file_unique_id, file_id in pending:
+            await self._validate(file_unique_id, file_id)
+
+    async def _validate(self, file_unique_id: str, file_id: str):
+        try:
+            await bot.get_file(file_id)
+        except TelegramBadRequest as e:
+            # get_file не отдаёт файлы больше 20 МБ, но file_id при этом рабочий
+            if "too big" not in str(e):
+                await self.db.set_media_valid(file_unique_id, False)
+                await self._notify_invalid(file_unique_id, str(e))
+                return
+        await self.db.set_media_valid(file_unique_id, True)
+
+    async def _notify_invalid(self, file_unique_id: str, error: str):
+        logger.warning(f"Media {file_unique_id} is no longer available: {error}")
+        for post_id, user_id, publish_time in await self.db.get_scheduled_posts_with_media(file_unique_id):
+            try:
+                await bot.send_message(
+                    user_id,
+                    f"⚠️ Файл в отложенном посте №{post_id} больше недоступен в Telegram.\n"
+                    f"Пост выйдет {publish_time} без этого файла. "
+                    "Чтобы сохранить файл, создайте пост заново."
+                )
+            except Exception as e:
+                logger.error(f"Failed to notify user {user_id}: {e}")
+
+# ==================== ОЧЕРЕДЬ ПУБЛИКАЦИЙ ====================
+def publish_report(rows: List[Dict]) -> str:
+    """Отчёт о публикации по строкам outbox одного batch"""
+    failed = [row for row in rows if row["status"] == "dead"]
+    lines = []
+    for row in rows:
+        name = html.escape(row["channel_name"] or str(row["chat_id"]))
+        if row["status"] == "dead":
+            lines.append(f"❌ {name}: {html.escape(row['last_error'] or '')}")
+        else:
+            lines.append(f"✅ {name}")
+
+    if not failed:
+        title = "✅ <b>Пост успешно опубликован!</b>"
+    elif len(failed) < len(rows):
+        title = f"⚠️ <b>Опубликовано в {len(rows) - len(failed)} из {len(rows)} каналов</b>"
+    else:
+        title = "❌ <b>Ошибка публикации</b>"
+    report = f"{title}\n\n" + "\n".join(lines)
+    if failed:
+        report += "\n\nПроверьте, что бот является администратором каналов с ошибками."
+    return report
+
+
+class Outbox:
+    """Надёжная доставка публикаций в каналы.
+
+    Публикация сначала записывается в таблицу outbox, затем её отправляет
+    фоновый цикл, до FANOUT_CONCURRENCY постов одновременно. Временные
+    ошибки (сеть, 429, 5xx) повторяются с экспоненциальной задержкой,
+    постоянные (бот не админ, чат не найден) и исчерпавшие
+    OUTBOX_MAX_ATTEMPTS попыток уходят в dead-letter (status = 'dead').
+    Ключ идемпотентности не даёт поставить пост дважды, а progress не даёт
+    повторить уже отправленные части поста. Когда все посты одной
+    публикации (batch) завершены, автор получает отчёт. В режиме воркеров
+    цикл работает только у лидера.
+    """
+
+    PERMANENT_ERRORS = (
+        TelegramBadRequest, TelegramForbiddenError, TelegramNotFound,
+        TelegramUnauthorizedError, TelegramEntityTooLarge,
+    )
+
+    def __init__(self, database: Database, concurrency: int = FANOUT_CONCURRENCY):
+        self.db = database
+        self.concurrency = concurrency
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._inflight: set = set()
+
+    async def enqueue(self, items: List[Dict]) -> int:
+        """Поставить публикации в очередь (см. Database.enqueue_outbox)"""
+        queued = await self.db.enqueue_outbox(items)
+        self.notify()
+        return queued
+
+    def notify(self):
+        """Разбудить цикл: в очереди могли появиться публикации"""
+        self._wakeup.set()
+
+    async def start(self):
+        """Разобрать прерванные отправки и запустить цикл"""
+        # Неизвестно, дошёл ли прерванный вызов до канала, поэтому не повторяем
+        for row in await self.db.get_outbox_sending():
+            logger.warning(f"Outbox post {row['id']} was interrupted during sending")
+            await self._finish(row, "dead", "публикация прервана перезапуском бота, проверьте канал")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """Остановить цикл и дать отправкам в процессе завершиться"""
+        if self._task:
+            # Флаг вместо cancel(): отмена, совпавшая с пробуждением, теряется в wait_for
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+            self._stopping = False
+        if self._inflight:
+            # Не успевшие за timeout останутся в sending и при старте уйдут в dead-letter
+            done, pending = await asyncio.wait(self._inflight, timeout=timeout)
+            for task in pending:
+                task.cancel()
+
+    async def _run(self):
+        cleaned_at = 0.0
+        while not self._stopping:
+            self._wakeup.clear()
+            delay = OUTBOX_CLEANUP_INTERVAL
+            try:
+                if time.time() - cleaned_at >= OUTBOX_CLEANUP_INTERVAL:
+                    cleaned_at = time.time()
+                    await self.db.delete_finished_outbox(cleaned_at - OUTBOX_RETENTION)
+
+                free = self.concurrency - len(self._inflight)
+                if free > 0:
+                    for row in await self.db.claim_outbox(time.time(), free):
+                        task = asyncio.create_task(self._deliver(row))
+                        self._inflight.add(task)
+                        task.add_done_callback(self._done)
+
+                # Свободных слотов нет - ждём завершения отправки, иначе ближайшего повтора
+                next_attempt = await self.db.get_next_outbox_attempt()
+                if next_attempt is not None and len(self._inflight) < self.concurrency:
+                    delay = min(delay, max(0.0, next_attempt - time.time()))
+            except Exception as e:
+                logger.error(f"Outbox loop failed: {e}")
+                delay = 5.0
+
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _done(self, task: asyncio.Task):
+        self._inflight.discard(task)
+        self._wakeup.set()
+
+    async def _deliver(self, row: Dict):
+        outbound_lane.set(LANE_PUBLISH)
+        try:
+            media = json.loads(row["media"]) if row["media"] else []
+            buttons = json.loads(row["buttons"]) if row["buttons"] else []
+            plan = renderer.compile(row["text"], media, buttons)
+
+            async def sent(progress: int):
+                await self.db.set_outbox_progress(row["id"], progress)
+
+            try:
+                await plan.send(row["chat_id"], start=row["progress"], on_sent=sent)
+            except Exception as e:
+                if isinstance(e, self.PERMANENT_ERRORS) or row["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+                    logger.error(f"Outbox post {row['id']} to {row['chat_id']} failed: {e}")
+                    if lost_channel_access(e):
+                        await channel_monitor.set_admin(row["chat_id"], False)
+                    await self._finish(row, "dead", str(e))
+                    return
+                delay = min(OUTBOX_MAX_DELAY, OUTBOX_BASE_DELAY * 2 ** (row["attempts"] - 1))
+                # Разброс, чтобы посты, упавшие вместе, не повторялись пачкой
+                delay = delay / 2 + random.uniform(0, delay / 2)
+                if isinstance(e, TelegramRetryAfter):
+                    delay = max(delay, e.retry_after)
+                logger.warning(f"Outbox post {row['id']} attempt {row['attempts']} failed, "
+                               f"retry in {delay:.0f}s: {e}")
+                await self.db.retry_outbox(row["id"], time.time() + delay, str(e))
+                return
+
+            await self._finish(row, "sent")
+            logger.info(f"Outbox post {row['id']} published to {row['chat_id']}")
+        except Exception as e:
+            # Строка осталась в sending: при следующем старте она попадёт в dead-letter
+            logger.error(f"Outbox post {row['id']} bookkeeping failed: {e}")
+
+    async def _finish(self, row: Dict, status: str, error: Optional[str] = None):
+        rows = await self.db.finish_outbox(row["id"], status, error)
+        if rows is not None:
+            await self._report(rows)
+
+    async def _report(self, rows: List[Dict]):
+        """Сообщить автору итог публикации"""
+        first = rows[0]
+        if first["report_message_id"]:
+            try:
+                await bot.edit_message_text(
+                    publish_report(rows)[:4096],
+                    chat_id=first["report_chat_id"],
+                    message_id=first["report_message_id"],
+                    reply_markup=get_main_menu(first["user_id"]),
+                    parse_mode="HTML"
+                )
+                return
+            except Exception as e:
+                logger.error(f"Failed to update publish report for {first['batch']}: {e}")
+
+        failed = [row for row in rows if row["status"] == "dead"]
+        if not failed:
+            return
+        try:
+            if first["scheduled_post_id"]:
+                await bot.send_message(
+                    first["user_id"],
+                    f"❌ Не удалось опубликовать отложенный пост №{first['scheduled_post_id']}:\n"
+                    f"{failed[0]['last_error']}"
+                )
+            else:
+                await bot.send_message(first["user_id"], publish_report(rows)[:4096], parse_mode="HTML")
+        except Exception as e:
+            logger.error(f"Failed to notify user {first['user_id']}: {e}")
+
+# ==================== ПЛАНИРОВЩИК ====================
+class PostScheduler:
+    """Публикация отложенных постов.
+
+    Сроки хранятся в min-heap в памяти: задача спит до ближайшего срока и
+    просыпается раньше только когда добавлен новый пост, таблица не опрашивается.
+    В режиме воркеров планировщик работает только у лидера, а посты, созданные
+    в других процессах, он подхватывает через sync().
+    """
+
+    def __init__(self, database: Database, concurrency: int = SCHEDULER_CONCURRENCY,
+                 batch: int = SCHEDULER_BATCH):
+        self.db = database
+        self.concurrency = concurrency
+        self.batch = batch
+        self._heap: List[tuple] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+
+    async def start(self):
+        """Загрузить ожидающие посты из БД и запустить цикл"""
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+
+        # Неизвестный исход доставки бывает только у outbox (см. Outbox.start), здесь пост не отправлялся
+        recovered = await self.db.recover_scheduled_posts()
+        if recovered:
+            logger.warning(f"{recovered} scheduled posts were not queued before restart, publishing them again")
+
+        for post_id, publish_time in await self.db.get_pending_schedule():
+            heapq.heappush(self._heap, (publish_time.timestamp(), post_id))
+        logger.info(f"Scheduler loaded {len(self._heap)} pending posts")
+
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить цикл и дождаться публикаций в процессе"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    def add(self, post_id: int, publish_time: datetime):
+        """Добавить пост в очередь и разбудить цикл"""
+        if not self._task:
+            return  # Планировщик в другом процессе, он найдёт пост через sync()
+        heapq.heappush(self._heap, (publish_time.timestamp(), post_id))
+        self._wakeup.set()
+
+    async def sync(self):
+        """Добавить в очередь ожидающие посты, которых в ней ещё нет"""
+        if not self._task:
+            return
+        known = {post_id for _, post_id in self._heap}
+        added = 0
+        for post_id, publish_time in await self.db.get_pending_schedule():
+            if post_id not in known:
+                heapq.heappush(self._heap, (publish_time.timestamp(), post_id))
+                added += 1
+        if added:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Слоты занимаем до claim и забираем не больше постов, чем свободно:
+            # пост, переведённый в sending без задачи, при остановке остался бы в нём
+            await self._slots.acquire()
+            free = 1
+            while free < self.batch and not self._slots.locked():
+                await self._slots.acquire()  # Свободный слот берётся без ожидания
+                free += 1
+
+            now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now and len(due) < free:
+                due.append(heapq.heappop(self._heap)[1])
+
+            claim = asyncio.ensure_future(self.db.claim_scheduled_posts(due))
+            try:
+                posts = await asyncio.shield(claim)
+            except asyncio.CancelledError:
+                # Остановка во время claim: транзакция всё равно завершится, возвращаем посты в pending
+                try:
+                    claimed = await claim
+                except Exception:
+                    claimed = []
+                for post in claimed:
+                    await self.db.set_scheduled_status(post["id"], "pending")
+                raise
+            except Exception as e:
+                logger.error(f"Scheduler failed to claim posts {due}: {e}")
+                for post_id in due:
+                    heapq.heappush(self._heap, (now + 5, post_id))
+                posts = []
+
+            # Между claim и созданием задач нет await - отмена сюда не попадёт
+            for _ in range(free - len(posts)):
+                self._slots.release()
+            for post in posts:
+                task = asyncio.create_task(self._publish(post))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+
+    async def _publish(self, post: Dict):
+        SCHEDULER_LAG.observe(max(0.0, time.time() - post["publish_time"].timestamp()))
+        try:
+            if not await self.db.is_channel_admin(post["user_id"], post["channel_id"]):
+                raise RuntimeError("бот не является администратором канала")
+            media = json.loads(post["media"]) if post["media"] else []
+            media, dropped = await media_registry.resolve(media)
+            if dropped:
+                logger.warning(f"Scheduled post {post['id']}: {dropped} unavailable files skipped")
+                if not media and not post["text"]:
+                    raise RuntimeError("все файлы поста недоступны в Telegram")
+
+            # Доставку, повторы и сообщение об ошибке берёт на себя outbox
+            await outbox.enqueue([{
+                "key": f"scheduled:{post['id']}",
+                "user_id": post["user_id"],
+                "chat_id": post["channel_id"],
+                "text": post["text"],
+                "media": media_json(media),
+                "buttons": post["buttons"],
+                "scheduled_post_id": post["id"],
+            }])
+            logger.info(f"Scheduled post {post['id']} queued for {post['channel_id']}")
+        except Exception as e:
+            logger.error(f"Error publishing scheduled post {post['id']}: {e}")
+            await self.db.set_scheduled_status(post["id"], "failed")
+            try:
+                await bot.send_message(
+                    post["user_id"],
+                    f"❌ Не удалось опубликовать отложенный пост №{post['id']}:\n{str(e)}"
+                )
+            except Exception:
+                pass
+        finally:
+            self._slots.release()
+
+# ==================== РАССЫЛКА ====================
+class BroadcastJob:
+    """Состояние одной рассылки.
+
+    cursor - наибольший user_id, до которого включительно все получатели
+    обработаны; он вместе со счётчиками периодически сохраняется в БД.
+    """
+
+    def __init__(self, job_id: int, admin_id: int, from_chat_id: int, message_id: int, total: int,
+                 cursor: int = 0, success: int = 0, failed: int = 0):
+        self.id = job_id
+        self.admin_id = admin_id
+        self.from_chat_id = from_chat_id
+        self.message_id = message_id
+        self.total = total
+        self.cursor = cursor
+        self.success = success
+        self.failed = failed
+        self.status_chat_id: Optional[int] = None
+        self.status_message_id: Optional[int] = None
+        self.started_at = time.monotonic()
+        self.started_done = success + failed
+        self.finished_at: Optional[float] = None
+        # Отправленные, но ещё не учтённые в cursor получатели (по возрастанию)
+        self._window: deque = deque()
+        self._results: Dict[int, bool] = {}
+        self._saved_success = success
+        self._saved_failed = failed
+
+    @classmethod
+    def from_row(cls, row: Dict) -> "BroadcastJob":
+        job = cls(row["id"], row["admin_id"], row["from_chat_id"], row["message_id"], row["total"],
+                  row["cursor"], row["success"], row["failed"])
+        job.status_chat_id = row["status_chat_id"]
+        job.status_message_id = row["status_message_id"]
+        return job
+
+    @property
+    def done(self) -> int:
+        return self.success + self.failed
+
+    @property
+    def running(self) -> bool:
+        return self.finished_at is None
+
+    def dispatched(self, user_id: int):
+        """Получатель передан воркерам"""
+        self._window.append(user_id)
+
+    def completed(self, user_id: int, ok: bool):
+        """Получатель обработан: двигаем cursor по непрерывному префиксу"""
+        if ok:
+            self.success += 1
+        else:
+            self.failed += 1
+        self._results[user_id] = ok
+
+        while self._window and self._window[0] in self._results:
+            done_id = self._window.popleft()
+            if self._results.pop(done_id):
+                self._saved_success += 1
+            else:
+                self._saved_failed += 1
+            self.cursor = done_id
+
+    def checkpoint(self) -> tuple:
+        """(cursor, success, failed) для сохранения в БД"""
+        return self.cursor, self._saved_success, self._saved_failed
+
+    def render(self) -> str:
+        """Текст статуса рассылки"""
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        rate = (self.done - self.started_done) / elapsed if elapsed > 0 else 0.0
+        title = "📤 <b>Рассылка в процессе...</b>" if self.running else "✅ <b>Рассылка завершена!</b>"
+        text = (
+            f"{title}\n\n"
+            f"✅ Успешно: {self.success}\n"
+            f"❌ Ошибок: {self.failed}\n"
+            f"📊 Всего: {self.total}\n"
+            f"⚡️ Скорость: {rate:.1f} сообщ./сек\n"
+            f"⏱ Прошло: {int(elapsed)} сек"
+        )
+        if self.running and rate > 0:
+            text += f"\n⏳ Осталось: ~{int(max(0, self.total - self.done) / rate)} сек"
+        return text
+
+
+class BroadcastManager:
+    """Фоновая рассылка: пул воркеров в полосе LANE_BULK общего лимита.
+
+    Хендлер только создаёт задачу и сразу возвращается; воркеры берут
+    получателей из очереди и отправляют через OutboundLimiter, уступая
+    ответам пользователям и публикациям,
+    а прогресс обновляется не чаще раза в BROADCAST_PROGRESS_INTERVAL секунд.
+    Рассылка хранится в таблице broadcasts и после перезапуска продолжается
+    с сохранённого cursor. При штатной остановке повторов нет; при падении
+    процесса повторно получат сообщение только те, кто был обработан после
+    последнего сохранения (не больше BROADCAST_CHECKPOINT_INTERVAL секунд).
+    """
+
+    def __init__(self, database: Database, workers: int = BROADCAST_WORKERS):
+        self.db = database
+        self.workers = workers
+        self.job: Optional[BroadcastJob] = None
+        # В режиме воркеров рассылки ведёт только лидер, остальные
+        # процессы лишь создают их в БД
+        self.standby = False
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._lock = asyncio.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self.job is not None and self.job.running
+
+    async def is_busy(self) -> bool:
+        """Идёт ли рассылка в этом или другом процессе"""
+        return self.busy or bool(await self.db.get_unfinished_broadcasts())
+
+    async def start(self, message: Message) -> BroadcastJob:
+        """Запустить рассылку сообщения message всем пользователям"""
+        async with self._lock:
+            total = await self.db.count_users()
+            job_id = await self.db.create_broadcast(message.from_user.id, message.chat.id, message.message_id, total)
+            job = BroadcastJob(job_id, message.from_user.id, message.chat.id, message.message_id, total)
+
+            status_message = await message.answer(job.render(), parse_mode="HTML")
+            job.status_chat_id = status_message.chat.id
+            job.status_message_id = status_message.message_id
+            await self.db.set_broadcast_status_message(job_id, job.status_chat_id, job.status_message_id)
+
+            if self.standby or self.busy:
+                logger.info(f"Broadcast {job_id} queued for the leader")
+            else:
+                self._launch(job)
+            return job
+
+    async def resume(self):
+        """Продолжить прерванную или созданную другим процессом рассылку"""
+        async with self._lock:
+            if self.standby or self.busy:
+                return
+            rows = await self.db.get_unfinished_broadcasts()
+            if not rows:
+                return
+            job = BroadcastJob.from_row(rows[0])
+            logger.info(f"Resuming broadcast {job.id} after user_id {job.cursor} ({job.done}/{job.total})")
+            self._launch(job)
+
+    async def stop(self, timeout: float = 10.0):
+        """Остановить рассылку: дождаться отправок в процессе и сохранить прогресс"""
+        if not self._task:
+            return
+        self._stopping = True
+        try:
+            await asyncio.wait_for(self._task, timeout=timeout)
+        except asyncio.TimeoutError:
+            pass  # wait_for уже отменил задачу
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._stopping = False
+
+    def _launch(self, job: BroadcastJob):
+        self.job = job
+        self._task = asyncio.create_task(self._run(job))
+
+    async def _run(self, job: BroadcastJob):
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+        workers = [asyncio.create_task(self._worker(job, queue)) for _ in range(self.workers)]
+        progress = asyncio.create_task(self._progress(job))
+        finished = False
+        try:
+            async for user_id in self.db.iter_users(after=job.cursor):
+                if self._stopping:
+                    break
+                job.dispatched(user_id)
+                await queue.put(user_id)
+            await queue.join()
+            finished = not self._stopping
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast {job.id} aborted: {e}")
+        finally:
+            for task in workers:
+                task.cancel()
+            progress.cancel()
+            await self._save(job, finished)
+            job.finished_at = time.monotonic()
+            if finished:
+                logger.info(f"Broadcast {job.id} finished: {job.success} ok, {job.failed} failed")
+                await self._edit_status(job, reply_markup=get_admin_panel_keyboard())
+
+    async def _worker(self, job: BroadcastJob, queue: asyncio.Queue):
+        outbound_lane.set(LANE_BULK)
+        while True:
+            user_id = await queue.get()
+            try:
+                # При остановке очередь только вычерпывается: cursor
+                # остановится перед первым неотправленным получателем
+                if not self._stopping:
+                    ok = await self._send(job, user_id)
+                    BROADCAST_SENT.inc("ok" if ok else "failed")
+                    job.completed(user_id, ok)
+            finally:
+                queue.task_done()
+
+    async def _send(self, job: BroadcastJob, user_id: int) -> bool:
+        try:
+            await bot.copy_message(
+                chat_id=user_id,
+                from_chat_id=job.from_chat_id,
+                message_id=job.message_id
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Broadcast error for user {user_id}: {e}")
+            return False
+
+    async def _progress(self, job: BroadcastJob):
+        last_edit = time.monotonic()
+        while True:
+            await asyncio.sleep(BROADCAST_CHECKPOINT_INTERVAL)
+            await self._save(job)
+            if time.monotonic() - last_edit >= BROADCAST_PROGRESS_INTERVAL:
+                last_edit = time.monotonic()
+                await self._edit_status(job)
+
+    async def _save(self, job: BroadcastJob, finished: bool = False):
+        """Сохранить cursor и счётчики одной транзакцией"""
+        cursor, success, failed = job.checkpoint()
+        try:
+            await self.db.save_broadcast_progress(job.id, cursor, success, failed, finished)
+        except Exception as e:
+            logger.error(f"Failed to checkpoint broadcast {job.id}: {e}")
+
+    async def _edit_status(self, job: BroadcastJob, reply_markup: Optional[InlineKeyboardMarkup] = None):
+        if not job.status_message_id:
+            return
+        try:
+            await bot.edit_message_text(
+                text=job.render(),
+                chat_id=job.status_chat_id,
+                message_id=job.status_message_id,
+                reply_markup=reply_markup,
+                parse_mode="HTML"
+            )
+        except TelegramBadRequest:
+            pass  # Текст не изменился
+        except Exception as e:
+            logger.error(f"Failed to update broadcast status: {e}")
+
+# ==================== АЛЬБОМЫ ====================
+class AlbumCollector:
+    """Склейка апдейтов одного альбома (media_group_id).
+
+    Telegram присылает каждый файл альбома отдельным сообщением. Коллектор
+    копит их, пока между файлами проходит меньше MEDIA_GROUP_WINDOW секунд,
+    и затем один раз вызывает on_complete со всеми файлами.
+    """
+
+    def __init__(self, window: float = MEDIA_GROUP_WINDOW, lanes: "UserLanes" = None):
+        self.window = window
+        # Сборка идёт вне апдейта: без полосы пользователя она гонится с его следующими апдейтами
+        self.lanes = lanes
+        self._albums: Dict[tuple, dict] = {}
+        self._tasks: set = set()  # Сборки в работе: цикл событий держит задачи только слабыми ссылками
+
+    def add(self, message: Message, state: FSMContext, item: Dict, on_complete):
+        """Добавить файл альбома; on_complete(message, state, items) вызовется один раз"""
+        key = (message.chat.id, message.media_group_id)
+        album = self._albums.get(key)
+        if album is None:
+            album = {"message": message, "state": state, "items": [], "timer": None}
+            self._albums[key] = album
+        album["items"].append((message.message_id, item))
+
+        # Каждый новый файл откладывает сборку ещё на window секунд
+        if album["timer"]:
+            album["timer"].cancel()
+        album["timer"] = asyncio.get_running_loop().call_later(self.window, self._flush, key, on_complete)
+
+    def _flush(self, key: tuple, on_complete):
+        task = asyncio.create_task(self._complete(key, on_complete))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _complete(self, key: tuple, on_complete):
+        album = self._albums.pop(key, None)
+        if album is None:
+            return
+        # Апдейты могли обработаться не по порядку
+        items = [item for _, item in sorted(album["items"], key=lambda pair: pair[0])]
+        message = album["message"]
+        try:
+            if self.lanes is not None and message.from_user is not None:
+                async with self.lanes.hold(message.from_user.id):
+                    await on_complete(message, album["state"], items)
+            else:
+                await on_complete(message, album["state"], items)
+        except Exception as e:
+            logger.error(f"Error handling media group {key[1]}: {e}")
+
+# ==================== ВОРКЕРЫ ====================
+def update_user_id(update: Dict[str, Any]) -> int:
+    """user_id автора апдейта (для каналов - id чата), 0 если его нет"""
+    for key, payload in update.items():
+        if key != "update_id" and isinstance(payload, dict):
+            owner = payload.get("from") or payload.get("user") or payload.get("chat") or {}
+            return owner.get("id", 0)
+    return 0
+
+
+class UpdateRouter:
+    """Раздаёт апдейты воркерам по хэшу user_id.
+
+    Все апдейты пользователя попадают в один процесс, поэтому его
+    FSM-сессия, альбомы и кэш каналов живут в памяти одного воркера.
+    """
+
+    def __init__(self, queues: List[Any]):
+        self.queues = queues
+
+    async def route(self, update: Dict[str, Any]):
+        queue = self.queues[hash(update_user_id(update)) % len(self.queues)]
+        # Очередь ограничена: если воркер не успевает, ждёт и приём апдейтов
+        await asyncio.get_running_loop().run_in_executor(None, queue.put, update)
+
+
+class LeaderElection:
+    """Выбор лидера среди воркеров через строку-аренду в таблице leases.
+
+    Лидер продлевает аренду каждые LEADER_RENEW_INTERVAL секунд и ведёт
+    планировщик, очередь публикаций и рассылки; если он перестал продлевать её дольше
+    LEADER_LEASE_TTL, аренду забирает другой воркер.
+    """
+
+    def __init__(self, database: Database, name: str = "jobs",
+                 ttl: float = LEADER_LEASE_TTL, interval: float = LEADER_RENEW_INTERVAL):
+        self.db = database
+        self.name = name
+        self.ttl = ttl
+        self.interval = interval
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self.is_leader = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        broadcaster.standby = True
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            await self._demote()
+            await self.db.release_lease(self.name, self.holder)
+            logger.info(f"{self.holder} released leadership")
+
+    async def _run(self):
+        while True:
+            try:
+                acquired = await self.db.acquire_lease(self.name, self.holder, self.ttl)
+            except Exception as e:
+                # Не смогли продлить - считаем, что аренда может перейти к другому
+                logger.error(f"Failed to renew lease {self.name}: {e}")
+                acquired = False
+
+            try:
+                if acquired and not self.is_leader:
+                    await self._promote()
+                elif not acquired and self.is_leader:
+                    logger.warning(f"{self.holder} lost leadership")
+                    await self._demote()
+                elif self.is_leader:
+                    await scheduler.sync()
+                    await broadcaster.resume()
+                    # Публикации, поставленные другими воркерами
+                    outbox.notify()
+            except Exception as e:
+                logger.error(f"Leader jobs failed: {e}")
+
+            await asyncio.sleep(self.interval)
+
+    async def _promote(self):
+        logger.info(f"{self.holder} became leader")
+        self.is_leader = True
+        broadcaster.standby = False
+        outbound.set_rate_limit(outbound_rate(leader=True))
+        await scheduler.start()
+        await outbox.start()
+        await media_registry.start()
+        await channel_monitor.start()
+        await broadcaster.resume()
+
+    async def _demote(self):
+        self.is_leader = False
+        broadcaster.standby = True
+        await broadcaster.stop()
+        await channel_monitor.stop()
+        await media_registry.stop()
+        await scheduler.stop()
+        await outbox.stop()
+        outbound.set_rate_limit(outbound_rate(leader=False))
+
+# ==================== МИДЛВАРИ ====================
+# callback_data кнопок бота: точные значения и префиксы перед id
+CALLBACK_ROUTES = frozenset({
+    "add_channel", "admin_panel", "broadcast", "broadcast_status", "cancel", "channels_done",
+    "confirm_publish", "continue_media", "create_post", "drafts", "main_menu", "my_channels",
+    "no", "publish_now", "save_draft", "schedule", "skip_media", "stats", "yes",
+})
+CALLBACK_PREFIXES = ("select_ch_", "del_ch_", "delete_draft_", "publish_draft_", "drafts_after_", "draft_",
+                     "btn_count_")
+
+
+def callback_route(data: Optional[str]) -> str:
+    """Маршрут кнопки для меток метрик и лимитов: "select_ch_12" -> "select_ch".
+
+    callback_data присылает клиент, и подделать её может кто угодно, поэтому
+    значение сводится к фиксированному набору, всё остальное - "other".
+    """
+    if not data:
+        return "other"
+    if data in CALLBACK_ROUTES:
+        return data
+    for prefix in CALLBACK_PREFIXES:
+        if data.startswith(prefix):
+            return prefix[:-1]
+    return "other"
+
+
+def registered_commands(router: Router) -> set:
+    """Команды из фильтров Command хендлеров сообщений: {"/start", ...}"""
+    commands = set()
+    for handler_object in router.message.handlers:
+        for handler_filter in handler_object.filters or ():
+            if isinstance(handler_filter.callback, Command):
+                commands.update(f"/{command}" for command in handler_filter.callback.commands
+                                if isinstance(command, str))
+    return commands
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время работы хендлеров по имени, префиксу callback_data и состоянию FSM.
+
+    Команда попадает в метку route, только если для неё есть хендлер:
+    иначе любой пользователь плодит новые серии метрик, присылая "/что-угодно".
+    """
+
+    def __init__(self, router: Router):
+        self.router = router
+        self._commands: Optional[set] = None
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        if self._commands is None:
+            # Хендлеры регистрируются декораторами ниже по модулю, поэтому список собираем при первом апдейте
+            self._commands = registered_commands(self.router)
+        command = event.text.split()[0].split("@")[0] if isinstance(event, Message) and event.text else ""
+        if isinstance(event, CallbackQuery):
+            route = callback_route(event.data)
+        elif command in self._commands:
+            route = command
+        else:
+            route = type(event).__name__.lower()
+        state = data.get("raw_state") or "none"
+
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name, route, state)
+
+
+class UserActivityMiddleware(BaseMiddleware):
+    """Отметка активности пользователей в личке (last_seen, username)"""
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        if user is not None and chat is not None and chat.type == "private":
+            user_registry.seen(user.id, user.username)
+        return await handler(event, data)
+
+
+class AntiFloodMiddleware(BaseMiddleware):
+    """Отсев флуда до очередей пользователей, FSM и БД.
+
+    Лимиты - token bucket на пользователя и на пару (пользователь, тип
+    кнопки); состояние корзин живёт в TTLCache и пропадает, когда корзина
+    успела бы наполниться заново. Повторное нажатие той же кнопки на том же
+    сообщении в течение duplicate_window отбрасывается как дубль.
+    """
+
+    def __init__(self, user_rate: float = FLOOD_USER_RATE, user_burst: int = FLOOD_USER_BURST,
+                 callback_rate: float = FLOOD_CALLBACK_RATE, callback_burst: int = FLOOD_CALLBACK_BURST,
+                 selection_rate: float = FLOOD_SELECTION_RATE, selection_burst: int = FLOOD_SELECTION_BURST,
+                 duplicate_window: float = FLOOD_DUPLICATE_WINDOW, maxsize: int = FLOOD_CACHE_SIZE):
+        self.user_limit = (user_rate, user_burst)
+        self.callback_limit = (callback_rate, callback_burst)
+        self.selection_limit = (selection_rate, selection_burst)
+        ttl = max(user_burst / user_rate, callback_burst / callback_rate, selection_burst / selection_rate)
+        self._buckets = TTLCache(maxsize, ttl)  # ключ -> [токены, время обновления]
+        self._recent = TTLCache(maxsize, duplicate_window)  # недавно принятые нажатия
+
+    def _allow(self, key, limit: tuple) -> bool:
+        rate, burst = limit
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        allowed = bucket[0] >= 1
+        if allowed:
+            bucket[0] -= 1
+        self._buckets.set(key, bucket)
+        return allowed
+
+    def check(self, user_id: int, callback: Optional[CallbackQuery] = None) -> Optional[str]:
+        """Причина отказа ("duplicate", "callback", "user") или None, если апдейт пропускается"""
+        if callback is not None:
+            message_id = callback.message.message_id if callback.message else callback.inline_message_id
+            tap = (user_id, message_id, callback.data)
+            if self._recent.get(tap):
+                return "duplicate"
+            route = callback_route(callback.data)
+            if route in FLOOD_SELECTION_ROUTES:
+                # Выбор 20-50 каналов упирается и в лимит кнопки, и в запас пользователя,
+                # поэтому такие нажатия считаются только в своём, более широком лимите
+                if not self._allow((user_id, route), self.selection_limit):
+                    return "callback"
+                self._recent.set(tap, True)
+                return None
+            if not self._allow((user_id, route), self.callback_limit):
+                return "callback"
+        if not self._allow(user_id, self.user_limit):
+            return "user"
+        if callback is not None:
+            self._recent.set(tap, True)
+        return None
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        callback = event.callback_query
+        reason = self.check(user.id, callback)
+        if reason is None:
+            return await handler(event, data)
+
+        FLOOD_DROPS.inc(reason, event.event_type)
+        # Отвечаем на отброшенные нажатия не чаще раза в duplicate_window:
+        # иначе флудер тратит на ответы тот же Bot API, что и остальные
+        if callback is not None and not self._recent.get(("answered", user.id)):
+            self._recent.set(("answered", user.id), True)
+            # Дубль закрываем молча, на частые нажатия - подсказка
+            try:
+                await callback.answer(None if reason == "duplicate" else "⏳ Слишком часто, подождите немного")
+            except Exception as e:
+                logger.debug(f"Failed to answer throttled callback: {e}")
+        return None
+
+
+class UserLane:
+    """Очередь апдейтов одного пользователя"""
+
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class UserLanes(BaseMiddleware):
+    """Апдейты одного пользователя по очереди, разных пользователей - параллельно.
+
+    Хендлеры читают данные FSM, меняют и записывают обратно (add_media,
+    add_button_name, add_button_link): два апдейта одного пользователя,
+    обработанные одновременно, затирают изменения друг друга. Очередь
+    пользователя ограничена max_pending - лишние апдейты отбрасываются, чтобы
+    один пользователь не копил в памяти тысячи задач. Полоса удаляется, как
+    только в ней не остаётся апдейтов, поэтому в памяти только активные.
+    """
+
+    def __init__(self, max_pending: int = USER_LANE_MAX_PENDING):
+        self.max_pending = max_pending
+        self._lanes: Dict[int, UserLane] = {}
+
+    def __len__(self) -> int:
+        return len(self._lanes)
+
+    @asynccontextmanager
+    async def hold(self, user_id: int):
+        """Выполнить блок в полосе пользователя (без лимита очереди)"""
+        lane = self._lanes.get(user_id)
+        if lane is None:
+            lane = self._lanes[user_id] = UserLane()
+            USER_LANES.set(len(self._lanes))
+        lane.pending += 1
+        try:
+            started = time.perf_counter()
+            # asyncio.Lock отдаёт блокировку ожидающим по порядку прихода
+            async with lane.lock:
+                USER_LANE_WAIT.observe(time.perf_counter() - started)
+                yield
+        finally:
+            lane.pending -= 1
+            if not lane.pending:
+                del self._lanes[user_id]
+                USER_LANES.set(len(self._lanes))
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        lane = self._lanes.get(user.id)
+        if lane is not None and lane.pending >= self.max_pending:
+            USER_LANE_DROPS.inc(event.event_type)
+            logger.warning(f"Dropped {event.event_type} from user {user.id}: {lane.pending} updates in queue")
+            if event.callback_query is not None:
+                # Иначе у пользователя крутятся часики на кнопке
+                try:
+                    await event.callback_query.answer("⏳ Подождите, предыдущее действие ещё выполняется")
+                except Exception as e:
+                    logger.debug(f"Failed to answer dropped callback: {e}")
+            return None
+
+        async with self.hold(user.id):
+            return await handler(event, data)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Время и ошибки запросов к Bot API по методам"""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - started, name)
 
 # ==================== ИНИЦИАЛИЗАЦИЯ ====================
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-router = Router()
 db = Database(DB_PATH)
+channel_cache = ChannelCache(db)
+metadata = TelegramMetadata()
+channel_monitor = ChannelMonitor(db, channel_cache)
+storage = SQLiteStorage(db)
+user_registry = UserRegistry(db)
+anti_flood = AntiFloodMiddleware()
+user_lanes = UserLanes()
+# FSM подключается вручную после полос пользователей: иначе состояние читается
+# до того, как апдейт дождался своей очереди, и хендлер выбирается по устаревшему
+dp = Dispatcher(storage=storage, disable_fsm=True)
+# Внешние мидлвари апдейтов идут после встроенной UserContextMiddleware, которая заполняет event_from_user
+dp.update.outer_middleware(anti_flood)
+dp.update.outer_middleware(user_lanes)
+dp.update.outer_middleware(dp.fsm)
+dp.update.outer_middleware(UserActivityMiddleware())
+router = Router()
+# В режиме воркеров воркер стартует нелидером, лидер получает свою долю в LeaderElection._promote
+outbound = OutboundLimiter(outbound_rate(leader=WORKERS <= 1))
+# Первая мидлварь внешняя: время в очереди лимита не попадает в malik_api_seconds
+bot.session.middleware(outbound)
+bot.session.middleware(ApiMetricsMiddleware())
+router.message.middleware(HandlerMetricsMiddleware(router))
+router.callback_query.middleware(HandlerMetricsMiddleware(router))
+scheduler = PostScheduler(db)
+media_registry = MediaRegistry(db)
+broadcaster = BroadcastManager(db)
+albums = AlbumCollector(lanes=user_lanes)
+renderer = PostRenderer()
+outbox = Outbox(db)
 
 # ==================== КЛАВИАТУРЫ ====================
 def get_main_menu(user_id: int) -> InlineKeyboardMarkup:
@@ -288,7 +3282,7 @@ def get_back_cancel_keyboard() -> InlineKeyboardMarkup:
 def get_media_keyboard(count: int) -> InlineKeyboardMarkup:
     """Клавиатура для добавления медиа"""
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"➡️ Продолжить ({count}/5)", callback_data="continue_media")],
+        [InlineKeyboardButton(text=f"➡️ Продолжить ({count}/{MAX_MEDIA})", callback_data="continue_media")],
         [InlineKeyboardButton(text="⏭ Пропустить", callback_data="skip_media")],
         [InlineKeyboardButton(text="❌ Отменить", callback_data="cancel")]
     ])
@@ -332,10 +3326,8 @@ def get_preview_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="❌ ОТМЕНИТЬ", callback_data="cancel")]
     ])
 
-async def get_channels_keyboard(user_id: int) -> InlineKeyboardMarkup:
-    """Клавиатура с каналами пользователя"""
-    channels = await db.get_user_channels(user_id)
-
+def build_channels_keyboard(channels: List[Dict], selected: frozenset) -> InlineKeyboardMarkup:
+    """Клавиатура выбора каналов (selected - id отмеченных каналов)"""
     if not channels:
         return InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="➕ Добавить канал", callback_data="add_channel")],
@@ -345,16 +3337,24 @@ async def get_channels_keyboard(user_id: int) -> InlineKeyboardMarkup:
     buttons = []
     for ch in channels:
         status = "✅" if ch["is_admin"] else "⚠️"
-        text = f"{status} {ch['channel_name']}"
+        mark = "☑️" if ch["id"] in selected else "⬜️"
+        text = f"{mark} {status} {ch['channel_name']}"
         buttons.append([InlineKeyboardButton(text=text, callback_data=f"select_ch_{ch['id']}")])
 
+    if selected:
+        buttons.append([InlineKeyboardButton(text=f"➡️ Далее ({len(selected)})", callback_data="channels_done")])
     buttons.append([InlineKeyboardButton(text="❌ Отменить", callback_data="cancel")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-async def get_manage_channels_keyboard(user_id: int) -> InlineKeyboardMarkup:
-    """Управление каналами"""
-    channels = await db.get_user_channels(user_id)
+async def get_channels_keyboard(user_id: int, selected: List[int] = ()) -> InlineKeyboardMarkup:
+    """Клавиатура с каналами пользователя"""
+    selected = frozenset(selected)
+    return await channel_cache.keyboard(
+        user_id, ("select", selected), lambda channels: build_channels_keyboard(channels, selected)
+    )
 
+def build_manage_channels_keyboard(channels: List[Dict]) -> InlineKeyboardMarkup:
+    """Управление каналами"""
     if not channels:
         return InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="➕ Добавить канал", callback_data="add_channel")],
@@ -373,10 +3373,15 @@ async def get_manage_channels_keyboard(user_id: int) -> InlineKeyboardMarkup:
     buttons.append([InlineKeyboardButton(text="◀️ Главное меню", callback_data="main_menu")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+async def get_manage_channels_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    """Управление каналами"""
+    return await channel_cache.keyboard(user_id, ("manage",), build_manage_channels_keyboard)
+
 def get_admin_panel_keyboard() -> InlineKeyboardMarkup:
     """Админ-панель"""
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📢 Рассылка", callback_data="broadcast")],
+        [InlineKeyboardButton(text="📡 Статус рассылки", callback_data="broadcast_status")],
         [InlineKeyboardButton(text="📊 Статистика", callback_data="stats")],
         [InlineKeyboardButton(text="◀️ Главное меню", callback_data="main_menu")]
     ])
@@ -387,7 +3392,7 @@ def get_admin_panel_keyboard() -> InlineKeyboardMarkup:
 async def cmd_start(message: Message, state: FSMContext):
     """Команда /start"""
     await state.clear()
-    await db.add_user(message.from_user.id, message.from_user.username)
+    user_registry.seen(message.from_user.id, message.from_user.username, register=True)
 
     welcome_text = (
         "👋 <b>Добро пожаловать в MalikPost!</b>\n\n"
@@ -436,7 +3441,7 @@ async def main_menu_handler(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "create_post")
 async def create_post_start(callback: CallbackQuery, state: FSMContext):
     """Начало создания поста"""
-    channels = await db.get_user_channels(callback.from_user.id)
+    channels = await channel_cache.get_channels(callback.from_user.id)
 
     if not channels:
         await callback.message.edit_text(
@@ -452,9 +3457,10 @@ async def create_post_start(callback: CallbackQuery, state: FSMContext):
         return
 
     await state.set_state(PostCreation.select_channel)
+    await state.update_data(channels=[])
     await callback.message.edit_text(
-        "📢 <b>Шаг 1/6: Выбор канала</b>\n\n"
-        "Выберите канал для публикации поста:",
+        "📢 <b>Шаг 1/6: Выбор каналов</b>\n\n"
+        "Отметьте один или несколько каналов для публикации поста:",
         reply_markup=await get_channels_keyboard(callback.from_user.id),
         parse_mode="HTML"
     )
@@ -462,20 +3468,40 @@ async def create_post_start(callback: CallbackQuery, state: FSMContext):
 
 @router.callback_query(PostCreation.select_channel, F.data.startswith("select_ch_"))
 async def select_channel(callback: CallbackQuery, state: FSMContext):
-    """Выбор канала"""
+    """Отметить канал / снять отметку"""
     channel_db_id = int(callback.data.split("_")[2])
-    channels = await db.get_user_channels(callback.from_user.id)
-    selected_channel = next((ch for ch in channels if ch["id"] == channel_db_id), None)
+    selected_channel = await channel_cache.get_channel(callback.from_user.id, channel_db_id)
 
     if not selected_channel:
         await callback.answer("❌ Канал не найден", show_alert=True)
         return
 
-    await state.update_data(channel=selected_channel, media=[], media_count=0)
+    data = await state.get_data()
+    selected = [ch for ch in data.get("channels", []) if ch["id"] != channel_db_id]
+    if len(selected) == len(data.get("channels", [])):
+        selected.append(selected_channel)
+    await state.update_data(channels=selected)
+
+    await callback.message.edit_reply_markup(
+        reply_markup=await get_channels_keyboard(callback.from_user.id, [ch["id"] for ch in selected])
+    )
+    await callback.answer()
+
+@router.callback_query(PostCreation.select_channel, F.data == "channels_done")
+async def channels_done(callback: CallbackQuery, state: FSMContext):
+    """Завершение выбора каналов"""
+    data = await state.get_data()
+    channels = data.get("channels", [])
+
+    if not channels:
+        await callback.answer("⚠️ Выберите хотя бы один канал", show_alert=True)
+        return
+
+    await state.update_data(media=[], media_count=0)
     await state.set_state(PostCreation.add_media)
 
     await callback.message.edit_text(
-        f"📢 <b>Канал:</b> {selected_channel['channel_name']}\n\n"
+        f"📢 <b>Каналы:</b> {format_channel_names(channels)}\n\n"
         "📸 <b>Шаг 2/6: Медиафайлы</b>\n\n"
         "Отправьте фото, видео или GIF (до 5 файлов)\n"
         "Или нажмите кнопку для продолжения.",
@@ -484,33 +3510,71 @@ async def select_channel(callback: CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
+def format_channel_names(channels: List[Dict], limit: int = 5) -> str:
+    """Названия каналов через запятую (не больше limit)"""
+    names = ", ".join(ch["channel_name"] for ch in channels[:limit])
+    if len(channels) > limit:
+        names += f" и ещё {len(channels) - limit}"
+    return names
+
+def extract_media(message: Message) -> Optional[Dict]:
+    """Тип и file_id медиа из сообщения"""
+    if message.photo:
+        media_type, file = "photo", message.photo[-1]
+    elif message.video:
+        media_type, file = "video", message.video
+    elif message.animation:
+        media_type, file = "animation", message.animation
+    else:
+        return None
+    return {
+        "type": media_type,
+        "file_id": file.file_id,
+        "file_unique_id": file.file_unique_id,
+        "file_size": file.file_size,
+    }
+
 @router.message(PostCreation.add_media, F.photo | F.video | F.animation)
 async def add_media(message: Message, state: FSMContext):
     """Добавление медиафайлов"""
-    data = await state.get_data()
-    media = data.get("media", [])
+    item = extract_media(message)
+    if not item:
+        return
 
-    if len(media) >= 5:
-        await message.answer("⚠️ Максимум 5 медиафайлов!")
+    # Файлы альбома собираем вместе: одно обновление состояния и один ответ
+    if message.media_group_id:
+        albums.add(message, state, item, save_media)
         return
 
-    if message.photo:
-        file_id = message.photo[-1].file_id
-        media_type = "photo"
-    elif message.video:
-        file_id = message.video.file_id
-        media_type = "video"
-    elif message.animation:
-        file_id = message.animation.file_id
-        media_type = "animation"
-    else:
+    await save_media(message, state, [item])
+
+async def save_media(message: Message, state: FSMContext, items: List[Dict]):
+    """Сохранение медиафайлов в состоянии"""
+    # Альбом собирается с задержкой: пользователь мог уже уйти с этого шага
+    if await state.get_state() != PostCreation.add_media.state:
         return
 
-    media.append({"type": media_type, "file_id": file_id})
+    data = await state.get_data()
+    media = data.get("media", [])
+
+    if len(media) >= MAX_MEDIA:
+        await message.answer(f"⚠️ Максимум {MAX_MEDIA} медиафайлов!")
+        return
+
+    accepted = items[:MAX_MEDIA - len(media)]
+    media.extend(accepted)
     await state.update_data(media=media, media_count=len(media))
+    await media_registry.register(accepted)
+
+    if len(accepted) == 1:
+        text = f"✅ Медиафайл добавлен ({len(media)}/{MAX_MEDIA})"
+    else:
+        text = f"✅ Добавлено медиафайлов: {len(accepted)} ({len(media)}/{MAX_MEDIA})"
+    if len(accepted) < len(items):
+        text += f"\n⚠️ Лишние файлы пропущены: максимум {MAX_MEDIA}"
 
     await message.answer(
-        f"✅ Медиафайл добавлен ({len(media)}/5)\n\n"
+        f"{text}\n\n"
         "Отправьте ещё или нажмите 'Продолжить'",
         reply_markup=get_media_keyboard(len(media))
     )
@@ -658,75 +3722,69 @@ async def publish_now(callback: CallbackQuery, state: FSMContext):
     await state.update_data(schedule=None)
     await show_preview(callback, state)
 
-async def show_preview(callback: CallbackQuery, state: FSMContext):
+@router.callback_query(PostCreation.schedule_time, F.data == "schedule")
+async def ask_schedule_time(callback: CallbackQuery, state: FSMContext):
+    """Запрос времени отложенной публикации"""
+    example = (datetime.now() + timedelta(hours=1)).strftime(SCHEDULE_INPUT_FORMAT)
+    await callback.message.edit_text(
+        "⏰ <b>Отложенная публикация</b>\n\n"
+        "Введите дату и время в формате ДД.ММ.ГГГГ ЧЧ:ММ\n"
+        f"Например: <code>{example}</code>",
+        reply_markup=get_back_cancel_keyboard(),
+        parse_mode="HTML"
+    )
+    await callback.answer()
+
+@router.message(PostCreation.schedule_time, F.text)
+async def set_schedule_time(message: Message, state: FSMContext):
+    """Установка времени отложенной публикации"""
+    try:
+        publish_time = datetime.strptime(message.text.strip(), SCHEDULE_INPUT_FORMAT)
+    except ValueError:
+        await message.answer("⚠️ Неверный формат! Используйте ДД.ММ.ГГГГ ЧЧ:ММ")
+        return
+
+    if publish_time <= datetime.now():
+        await message.answer("⚠️ Время публикации должно быть в будущем!")
+        return
+
+    await state.update_data(schedule=publish_time.strftime(SCHEDULE_DB_FORMAT))
+    await show_preview(message, state)
+
+async def show_preview(event, state: FSMContext):
     """Показать предпросмотр поста"""
     data = await state.get_data()
     text = data.get("text", "")
     media = data.get("media", [])
     buttons = data.get("buttons", [])
-    channel = data.get("channel", {})
+    channels = data.get("channels", [])
+    schedule = data.get("schedule")
+    message = event.message if isinstance(event, CallbackQuery) else event
 
     await state.set_state(PostCreation.preview)
 
-    # Формируем клавиатуру с кнопками поста
-    post_buttons = []
-    if buttons:
-        for btn in buttons:
-            post_buttons.append([InlineKeyboardButton(text=btn["text"], url=btn["url"])])
-
-    post_keyboard = InlineKeyboardMarkup(inline_keyboard=post_buttons) if post_buttons else None
-
     preview_text = (
         f"👁 <b>Предпросмотр поста</b>\n\n"
-        f"📢 <b>Канал:</b> {channel.get('channel_name', 'Неизвестно')}\n"
+        f"📢 <b>Каналы ({len(channels)}):</b> {format_channel_names(channels)}\n"
         f"📸 <b>Медиа:</b> {len(media)} файл(ов)\n"
-        f"🔘 <b>Кнопок:</b> {len(buttons)}\n\n"
-        f"<b>Текст:</b>\n{text[:200]}{'...' if len(text) > 200 else ''}"
+        f"🔘 <b>Кнопок:</b> {len(buttons)}\n"
     )
+    if schedule:
+        publish_time = datetime.strptime(schedule, SCHEDULE_DB_FORMAT)
+        preview_text += f"⏰ <b>Публикация:</b> {publish_time.strftime(SCHEDULE_INPUT_FORMAT)}\n"
+    preview_text += f"\n<b>Текст:</b>\n{text[:200]}{'...' if len(text) > 200 else ''}"
 
-    # Отправляем предпросмотр
-    if media:
-        # Если есть медиа, отправляем его с текстом
-        if len(media) == 1:
-            m = media[0]
-            if m["type"] == "photo":
-                await callback.message.answer_photo(
-                    photo=m["file_id"],
-                    caption=text,
-                    reply_markup=post_keyboard
-                )
-            elif m["type"] == "video":
-                await callback.message.answer_video(
-                    video=m["file_id"],
-                    caption=text,
-                    reply_markup=post_keyboard
-                )
-            elif m["type"] == "animation":
-                await callback.message.answer_animation(
-                    animation=m["file_id"],
-                    caption=text,
-                    reply_markup=post_keyboard
-                )
-        else:
-            # Несколько медиа - используем media group
-            media_group = []
-            for i, m in enumerate(media):
-                if m["type"] == "photo":
-                    media_group.append(InputMediaPhoto(media=m["file_id"], caption=text if i == 0 else None))
-                elif m["type"] == "video":
-                    media_group.append(InputMediaVideo(media=m["file_id"], caption=text if i == 0 else None))
-
-            await callback.message.answer_media_group(media=media_group)
-            if post_buttons:
-                await callback.message.answer("Кнопки:", reply_markup=post_keyboard)
+    # Отправляем предпросмотр тем же планом, что уйдёт в канал
+    await renderer.compile(text, media, buttons).send(message.chat.id)
 
     # Отправляем кнопки управления
-    await callback.message.answer(
+    await message.answer(
         preview_text,
         reply_markup=get_preview_keyboard(),
         parse_mode="HTML"
     )
-    await callback.answer()
+    if isinstance(event, CallbackQuery):
+        await event.answer()
 
 @router.callback_query(PostCreation.preview, F.data == "confirm_publish")
 async def confirm_publish(callback: CallbackQuery, state: FSMContext):
@@ -735,81 +3793,77 @@ async def confirm_publish(callback: CallbackQuery, state: FSMContext):
     text = data.get("text", "")
     media = data.get("media", [])
     buttons = data.get("buttons", [])
-    channel = data.get("channel", {})
-
-    # Формируем клавиатуру
-    post_buttons = []
-    if buttons:
-        for btn in buttons:
-            post_buttons.append([InlineKeyboardButton(text=btn["text"], url=btn["url"])])
+    channels = data.get("channels", [])
+    schedule = data.get("schedule")
 
-    post_keyboard = InlineKeyboardMarkup(inline_keyboard=post_buttons) if post_buttons else None
+    media_data = media_json(media)
+    buttons_json = json.dumps(buttons)
 
-    try:
-        channel_id = channel["channel_id"]
-
-        # Публикуем пост
-        if media:
-            if len(media) == 1:
-                m = media[0]
-                if m["type"] == "photo":
-                    await bot.send_photo(
-                        chat_id=channel_id,
-                        photo=m["file_id"],
-                        caption=text,
-                        reply_markup=post_keyboard
-                    )
-                elif m["type"] == "video":
-                    await bot.send_video(
-                        chat_id=channel_id,
-                        video=m["file_id"],
-                        caption=text,
-                        reply_markup=post_keyboard
-                    )
-                elif m["type"] == "animation":
-                    await bot.send_animation(
-                        chat_id=channel_id,
-                        animation=m["file_id"],
-                        caption=text,
-                        reply_markup=post_keyboard
-                    )
-            else:
-                # Несколько медиа
-                media_group = []
-                for i, m in enumerate(media):
-                    if m["type"] == "photo":
-                        media_group.append(InputMediaPhoto(media=m["file_id"], caption=text if i == 0 else None))
-                    elif m["type"] == "video":
-                        media_group.append(InputMediaVideo(media=m["file_id"], caption=text if i == 0 else None))
-
-                await bot.send_media_group(chat_id=channel_id, media=media_group)
-                if post_buttons:
-                    await bot.send_message(chat_id=channel_id, text="👆 Кнопки к посту:", reply_markup=post_keyboard)
-        else:
-            # Только текст
-            await bot.send_message(
-                chat_id=channel_id,
-                text=text,
-                reply_markup=post_keyboard
+    # Отложенная публикация: сохраняем пост для каждого канала и передаём планировщику
+    if schedule:
+        publish_time = datetime.strptime(schedule, SCHEDULE_DB_FORMAT)
+        for channel in channels:
+            post_id = await db.add_scheduled_post(
+                callback.from_user.id,
+                channel["channel_id"],
+                text,
+                media_data,
+                buttons_json,
+                publish_time
             )
+            scheduler.add(post_id, publish_time)
 
         await state.clear()
         await callback.message.answer(
-            "✅ <b>Пост успешно опубликован!</b>",
+            f"⏰ <b>Пост запланирован!</b>\n\n"
+            f"📢 {format_channel_names(channels)}\n"
+            f"🕐 {publish_time.strftime(SCHEDULE_INPUT_FORMAT)}",
             reply_markup=get_main_menu(callback.from_user.id),
             parse_mode="HTML"
         )
-        await callback.answer("✅ Успешно опубликовано!")
+        await callback.answer("⏰ Запланировано!")
+        return
 
-    except Exception as e:
-        logger.error(f"Error publishing post: {e}")
+    await state.clear()
+
+    # Каналы, где бот уже известно что не админ, сразу попадают в отчёт как неудачные
+    current = {ch["id"]: ch for ch in await channel_cache.get_channels(callback.from_user.id)}
+    broken = {ch["id"] for ch in channels if not current.get(ch["id"], ch)["is_admin"]}
+    if len(broken) == len(channels):
         await callback.message.answer(
-            f"❌ <b>Ошибка публикации:</b>\n{str(e)}\n\n"
-            "Проверьте, что бот является администратором канала.",
+            f"⚠️ <b>Бот не является администратором каналов</b>\n\n"
+            f"📢 {format_channel_names(channels)}\n\n"
+            "Добавьте бота в каналы как администратора и опубликуйте пост снова.",
             reply_markup=get_main_menu(callback.from_user.id),
             parse_mode="HTML"
         )
-        await callback.answer("❌ Ошибка публикации", show_alert=True)
+        await callback.answer("⚠️ Нет доступных каналов", show_alert=True)
+        return
+
+    await callback.answer("📤 Публикуем...")
+    status_msg = await callback.message.answer(f"📤 Публикация в {len(channels) - len(broken)} канал(ов)...")
+
+    # Посты уходят через outbox: временные ошибки повторяются, а отчёт
+    # в status_msg приходит, когда обработаны все каналы. Ключ по id
+    # нажатия защищает от повторной доставки того же апдейта
+    batch = f"publish:{callback.id}"
+    await outbox.enqueue([
+        {
+            "key": f"{batch}:{channel['channel_id']}",
+            "batch": batch,
+            "user_id": callback.from_user.id,
+            "chat_id": channel["channel_id"],
+            "channel_name": channel["channel_name"],
+            "text": text,
+            "media": media_data,
+            "buttons": buttons_json,
+            "report_chat_id": status_msg.chat.id,
+            "report_message_id": status_msg.message_id,
+            **({"status": "dead", "last_error": "бот не является администратором канала"}
+               if channel["id"] in broken else {}),
+        }
+        for channel in channels
+    ])
 
 @router.callback_query(PostCreation.preview, F.data == "save_draft")
 async def save_draft(callback: CallbackQuery, state: FSMContext):
@@ -818,25 +3872,27 @@ async def save_draft(callback: CallbackQuery, state: FSMContext):
     text = data.get("text", "")
     media = data.get("media", [])
     buttons = data.get("buttons", [])
-    channel = data.get("channel", {})
+    channels = data.get("channels", [])
 
-    # Сохраняем в БД
-    media_json = json.dumps([{"type": m["type"], "file_id": m["file_id"]} for m in media])
+    # Сохраняем в БД: черновики привязаны к каналу, поэтому по одному на канал
+    media_data = media_json(media)
     buttons_json = json.dumps(buttons)
 
-    was_deleted = await db.add_draft(
-        callback.from_user.id,
-        channel["channel_id"],
-        text,
-        media_json,
-        buttons_json
-    )
+    was_deleted = False
+    for channel in channels:
+        was_deleted |= await db.add_draft(
+            callback.from_user.id,
+            channel["channel_id"],
+            text,
+            media_data,
+            buttons_json
+        )
 
     await state.clear()
 
     msg = "💾 <b>Черновик сохранён!</b>"
     if was_deleted:
-        msg += "\n\n⚠️ Достигнут лимит черновиков (5). Самый старый черновик был удалён."
+        msg += f"\n\n⚠️ Достигнут лимит черновиков ({DRAFTS_LIMIT}). Самый старый черновик был удалён."
 
     await callback.message.answer(
         msg,
@@ -850,7 +3906,7 @@ async def save_draft(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "my_channels")
 async def my_channels(callback: CallbackQuery):
     """Показать мои каналы"""
-    channels = await db.get_user_channels(callback.from_user.id)
+    channels = await channel_cache.get_channels(callback.from_user.id)
 
     if not channels:
         text = "⚠️ <b>У вас нет добавленных каналов</b>\n\nДобавьте канал для начала работы."
@@ -868,7 +3924,8 @@ async def my_channels(callback: CallbackQuery):
 async def delete_channel(callback: CallbackQuery):
     """Удаление канала"""
     channel_db_id = int(callback.data.split("_")[2])
-    await db.delete_channel(channel_db_id)
+    await db.delete_channel(channel_db_id, callback.from_user.id)
+    channel_cache.invalidate(callback.from_user.id)
 
     await callback.answer("🗑 Канал удалён", show_alert=True)
     await my_channels(callback)
@@ -902,7 +3959,7 @@ async def add_channel_process(message: Message, state: FSMContext):
     # Если отправлен username
     elif message.text and message.text.startswith("@"):
         try:
-            chat = await bot.get_chat(message.text)
+            chat = await metadata.get_chat(message.text)
             if chat.type == "channel":
                 channel_id = chat.id
                 channel_name = chat.title
@@ -919,13 +3976,13 @@ async def add_channel_process(message: Message, state: FSMContext):
 
     # Проверяем, является ли бот администратором
     try:
-        bot_member = await bot.get_chat_member(channel_id, bot.id)
+        bot_member = await metadata.get_chat_member(channel_id, bot.id)
         is_admin = bot_member.status in ["administrator", "creator"]
 
         if not is_admin:
             await message.answer(
                 "⚠️ <b>Бот не является администратором канала!</b>\n\n"
-                f"Добавьте бота @{(await bot.get_me()).username} в канал '{channel_name}' "
+                f"Добавьте бота @{(await metadata.get_me()).username} в канал '{channel_name}' "
                 "как администратора с правами на публикацию сообщений.",
                 parse_mode="HTML"
             )
@@ -933,6 +3990,7 @@ async def add_channel_process(message: Message, state: FSMContext):
 
         # Добавляем канал в БД
         await db.add_channel(message.from_user.id, channel_id, channel_name, is_admin)
+        channel_cache.invalidate(message.from_user.id)
         await state.clear()
 
         await message.answer(
@@ -951,14 +4009,33 @@ async def add_channel_process(message: Message, state: FSMContext):
             parse_mode="HTML"
         )
 
+@router.my_chat_member(F.chat.type == "channel")
+async def bot_channel_status(event: ChatMemberUpdated):
+    """Бота назначили админом канала, сняли права или удалили из канала"""
+    metadata.set_chat_member(event.chat.id, event.new_chat_member.user.id, event.new_chat_member)
+    metadata.invalidate_chat(event.chat.id)
+    is_admin = event.new_chat_member.status in ("administrator", "creator")
+    await channel_monitor.set_admin(event.chat.id, is_admin, event.chat.title)
+
 # ==================== ЧЕРНОВИКИ ====================
 
 @router.callback_query(F.data == "drafts")
+@router.callback_query(F.data.startswith("drafts_after_"))
 async def show_drafts(callback: CallbackQuery):
-    """Показать черновики"""
-    drafts = await db.get_user_drafts(callback.from_user.id)
-
-    if not drafts:
+    """Показать страницу черновиков"""
+    # drafts_after_<created_ts>-<id>; кнопки старого формата ведут на первую страницу
+    after = None
+    cursor = callback.data[len("drafts_after_"):]
+    if "-" in cursor:
+        created_ts, draft_id = cursor.split("-")
+        after = (int(created_ts), int(draft_id))
+
+    # Лишняя запись показывает, есть ли следующая страница
+    drafts = await db.get_user_drafts(callback.from_user.id, after=after, limit=DRAFTS_PAGE_SIZE + 1)
+    has_next = len(drafts) > DRAFTS_PAGE_SIZE
+    drafts = drafts[:DRAFTS_PAGE_SIZE]
+
+    if not drafts and after is None:
         await callback.message.edit_text(
             "📋 <b>Черновики</b>\n\n"
             "У вас пока нет сохранённых черновиков.",
@@ -974,19 +4051,24 @@ async def show_drafts(callback: CallbackQuery):
     buttons = []
     for draft in drafts:
         date = datetime.fromisoformat(draft["created_at"]).strftime("%d.%m.%Y %H:%M")
-        preview = draft["text"][:30] + "..." if len(draft["text"]) > 30 else draft["text"]
-        media_count = len(json.loads(draft["media"])) if draft["media"] else 0
-
-        text = f"📅 {date} | {draft['channel_name']}\n{preview}"
-        if media_count:
-            text += f" | 📸 {media_count}"
+        text = f"📅 {date} | {draft['channel_name']}\n{draft['preview']}"
+        if draft["media_count"]:
+            text += f" | 📸 {draft['media_count']}"
 
         buttons.append([InlineKeyboardButton(text=text, callback_data=f"draft_{draft['id']}")])
 
+    navigation = []
+    if after is not None:
+        navigation.append(InlineKeyboardButton(text="⏮ В начало", callback_data="drafts"))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="Дальше ▶️", callback_data=f"drafts_after_{drafts[-1]['created_ts']}-{drafts[-1]['id']}"))
+    if navigation:
+        buttons.append(navigation)
     buttons.append([InlineKeyboardButton(text="◀️ Главное меню", callback_data="main_menu")])
 
     await callback.message.edit_text(
-        f"📋 <b>Черновики ({len(drafts)}/5)</b>\n\n"
+        "📋 <b>Черновики</b>\n\n"
+        f"Хранится до {DRAFTS_LIMIT} последних черновиков.\n"
         "Выберите черновик:",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
         parse_mode="HTML"
@@ -1006,6 +4088,7 @@ async def show_draft(callback: CallbackQuery, state: FSMContext):
     # Сохраняем данные черновика в state для публикации
     media = json.loads(draft["media"]) if draft["media"] else []
     buttons = json.loads(draft["buttons"]) if draft["buttons"] else []
+    media, _ = await media_registry.resolve(media)
 
     await state.update_data(
         draft_id=draft_id,
@@ -1015,14 +4098,6 @@ async def show_draft(callback: CallbackQuery, state: FSMContext):
         buttons=buttons
     )
 
-    # Формируем клавиатуру с кнопками поста
-    post_buttons = []
-    if buttons:
-        for btn in buttons:
-            post_buttons.append([InlineKeyboardButton(text=btn["text"], url=btn["url"])])
-
-    post_keyboard = InlineKeyboardMarkup(inline_keyboard=post_buttons) if post_buttons else None
-
     # Показываем предпросмотр
     preview_text = (
         f"📋 <b>Черновик</b>\n\n"
@@ -1033,38 +4108,7 @@ async def show_draft(callback: CallbackQuery, state: FSMContext):
     )
 
     # Отправляем предпросмотр с медиа
-    if media:
-        if len(media) == 1:
-            m = media[0]
-            if m["type"] == "photo":
-                await callback.message.answer_photo(
-                    photo=m["file_id"],
-                    caption=draft["text"],
-                    reply_markup=post_keyboard
-                )
-            elif m["type"] == "video":
-                await callback.message.answer_video(
-                    video=m["file_id"],
-                    caption=draft["text"],
-                    reply_markup=post_keyboard
-                )
-            elif m["type"] == "animation":
-                await callback.message.answer_animation(
-                    animation=m["file_id"],
-                    caption=draft["text"],
-                    reply_markup=post_keyboard
-                )
-        else:
-            media_group = []
-            for i, m in enumerate(media):
-                if m["type"] == "photo":
-                    media_group.append(InputMediaPhoto(media=m["file_id"], caption=draft["text"] if i == 0 else None))
-                elif m["type"] == "video":
-                    media_group.append(InputMediaVideo(media=m["file_id"], caption=draft["text"] if i == 0 else None))
-
-            await callback.message.answer_media_group(media=media_group)
-            if post_buttons:
-                await callback.message.answer("Кнопки:", reply_markup=post_keyboard)
+    await renderer.compile(draft["text"], media, buttons).send(callback.message.chat.id)
 
     # Кнопки управления черновиком
     manage_buttons = InlineKeyboardMarkup(inline_keyboard=[
@@ -1090,79 +4134,41 @@ async def publish_draft(callback: CallbackQuery, state: FSMContext):
         await callback.answer("❌ Черновик не найден", show_alert=True)
         return
 
-    media = json.loads(draft["media"]) if draft["media"] else []
-    buttons = json.loads(draft["buttons"]) if draft["buttons"] else []
-
-    # Формируем клавиатуру
-    post_buttons = []
-    if buttons:
-        for btn in buttons:
-            post_buttons.append([InlineKeyboardButton(text=btn["text"], url=btn["url"])])
-
-    post_keyboard = InlineKeyboardMarkup(inline_keyboard=post_buttons) if post_buttons else None
-
-    try:
-        # Публикуем
-        if media:
-            if len(media) == 1:
-                m = media[0]
-                if m["type"] == "photo":
-                    await bot.send_photo(
-                        chat_id=draft["channel_id"],
-                        photo=m["file_id"],
-                        caption=draft["text"],
-                        reply_markup=post_keyboard
-                    )
-                elif m["type"] == "video":
-                    await bot.send_video(
-                        chat_id=draft["channel_id"],
-                        video=m["file_id"],
-                        caption=draft["text"],
-                        reply_markup=post_keyboard
-                    )
-                elif m["type"] == "animation":
-                    await bot.send_animation(
-                        chat_id=draft["channel_id"],
-                        animation=m["file_id"],
-                        caption=draft["text"],
-                        reply_markup=post_keyboard
-                    )
-            else:
-                media_group = []
-                for i, m in enumerate(media):
-                    if m["type"] == "photo":
-                        media_group.append(InputMediaPhoto(media=m["file_id"], caption=draft["text"] if i == 0 else None))
-                    elif m["type"] == "video":
-                        media_group.append(InputMediaVideo(media=m["file_id"], caption=draft["text"] if i == 0 else None))
-
-                await bot.send_media_group(chat_id=draft["channel_id"], media=media_group)
-                if post_buttons:
-                    await bot.send_message(chat_id=draft["channel_id"], text="👆 Кнопки к посту:", reply_markup=post_keyboard)
-        else:
-            await bot.send_message(
-                chat_id=draft["channel_id"],
-                text=draft["text"],
-                reply_markup=post_keyboard
-            )
-
-        # Удаляем черновик после публикации
-        await db.delete_draft(draft_id)
-
-        await callback.message.answer(
-            "✅ <b>Черновик успешно опубликован!</b>",
-            reply_markup=get_main_menu(callback.from_user.id),
-            parse_mode="HTML"
+    if not await db.is_channel_admin(callback.from_user.id, draft["channel_id"]):
+        await callback.answer(
+            f"⚠️ Бот не является администратором канала «{draft['channel_name']}». "
+            "Добавьте его как администратора и повторите.",
+            show_alert=True
         )
-        await callback.answer("✅ Опубликовано!")
+        return
 
-    except Exception as e:
-        logger.error(f"Error publishing draft: {e}")
-        await callback.message.answer(
-            f"❌ <b>Ошибка публикации:</b>\n{str(e)}",
-            reply_markup=get_main_menu(callback.from_user.id),
-            parse_mode="HTML"
+    media = json.loads(draft["media"]) if draft["media"] else []
+    media, _ = await media_registry.resolve(media)
+
+    status_msg = await callback.message.answer("📤 Публикуем черновик...")
+
+    # Черновик удаляется, когда outbox доставит пост; ключ по id черновика
+    # не даёт опубликовать его дважды, пока идёт доставка
+    queued = await outbox.enqueue([{
+        "key": f"draft:{draft_id}",
+        "user_id": callback.from_user.id,
+        "chat_id": draft["channel_id"],
+        "channel_name": draft["channel_name"],
+        "text": draft["text"],
+        "media": media_json(media),
+        "buttons": draft["buttons"],
+        "draft_id": draft_id,
+        "report_chat_id": status_msg.chat.id,
+        "report_message_id": status_msg.message_id,
+    }])
+    if not queued:
+        await status_msg.edit_text(
+            "⏳ Этот черновик уже публикуется",
+            reply_markup=get_main_menu(callback.from_user.id)
         )
-        await callback.answer("❌ Ошибка публикации", show_alert=True)
+        await callback.answer()
+        return
+    await callback.answer("📤 Публикуем...")
 
 @router.callback_query(F.data.startswith("delete_draft_"))
 async def delete_draft(callback: CallbackQuery):
@@ -1196,11 +4202,11 @@ async def show_stats(callback: CallbackQuery):
         await callback.answer("⛔️ Доступ запрещён", show_alert=True)
         return
 
-    users = await db.get_all_users()
+    users_count = await db.count_users()
 
     stats_text = (
         "📊 <b>Статистика бота</b>\n\n"
-        f"👥 Всего пользователей: {len(users)}\n"
+        f"👥 Всего пользователей: {users_count}\n"
     )
 
     await callback.message.edit_text(
@@ -1231,79 +4237,274 @@ async def broadcast_start(callback: CallbackQuery, state: FSMContext):
 @router.message(AdminPanel.broadcast_message)
 async def broadcast_process(message: Message, state: FSMContext):
     """Обработка рассылки"""
-    users = await db.get_all_users()
+    await state.clear()
 
-    success = 0
-    failed = 0
+    if await broadcaster.is_busy():
+        await message.answer(
+            "⚠️ Рассылка уже идёт. Статус: /broadcast_status",
+            reply_markup=get_admin_panel_keyboard()
+        )
+        return
 
-    status_msg = await message.answer(
-        f"📤 Рассылка началась...\n\n"
-        f"✅ Успешно: {success}\n"
-        f"❌ Ошибок: {failed}\n"
-        f"📊 Всего: {len(users)}"
-    )
+    # Рассылка идёт в фоне, хендлер сразу освобождается
+    await broadcaster.start(message)
+
+@router.message(Command("broadcast_status"))
+@router.callback_query(F.data == "broadcast_status")
+async def broadcast_status(event):
+    """Статус текущей или последней рассылки"""
+    if event.from_user.id not in ADMIN_IDS:
+        if isinstance(event, CallbackQuery):
+            await event.answer("⛔️ Доступ запрещён", show_alert=True)
+        return
 
-    for user_id in users:
+    job = broadcaster.job
+    if not job:
+        # Рассылку может вести другой воркер: показываем прогресс из БД
+        row = await db.get_last_broadcast()
+        if row:
+            job = BroadcastJob.from_row(row)
+            if row["status"] != "running":
+                job.finished_at = job.started_at
+    text = job.render() if job else "📭 Рассылок ещё не было."
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="broadcast_status")],
+        [InlineKeyboardButton(text="◀️ Админ панель", callback_data="admin_panel")]
+    ])
+
+    if isinstance(event, CallbackQuery):
         try:
-            await bot.copy_message(
-                chat_id=user_id,
-                from_chat_id=message.chat.id,
-                message_id=message.message_id
-            )
-            success += 1
-        except Exception as e:
-            failed += 1
-            logger.error(f"Broadcast error for user {user_id}: {e}")
+            await event.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+        except TelegramBadRequest:
+            pass  # Статус не изменился
+        await event.answer()
+    else:
+        await event.answer(text, reply_markup=keyboard, parse_mode="HTML")
 
-        # Обновляем статус каждые 10 пользователей
-        if (success + failed) % 10 == 0:
-            try:
-                await status_msg.edit_text(
-                    f"📤 Рассылка в процессе...\n\n"
-                    f"✅ Успешно: {success}\n"
-                    f"❌ Ошибок: {failed}\n"
-                    f"📊 Всего: {len(users)}"
-                )
-            except:
-                pass
+# ==================== ЗАПУСК ====================
 
-        await asyncio.sleep(0.05)  # Небольшая задержка
+async def wait_for_stop_signal():
+    """Дождаться SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    try:
+        await stop_event.wait()
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
 
-    await state.clear()
-    await status_msg.edit_text(
-        f"✅ <b>Рассылка завершена!</b>\n\n"
-        f"✅ Успешно: {success}\n"
-        f"❌ Ошибок: {failed}\n"
-        f"📊 Всего пользователей: {len(users)}",
-        reply_markup=get_admin_panel_keyboard(),
-        parse_mode="HTML"
+
+async def run_polling(server: WebServer):
+    """Long polling; HTTP-сервер отвечает только на health-check"""
+    await server.start()
+
+    # Удаление вебхука
+    await bot.delete_webhook(drop_pending_updates=True)
+    logger.info("Bot started polling")
+
+    # Сессию закрывает main после остановки фоновых отправок
+    await dp.start_polling(bot, close_bot_session=False)
+
+
+async def run_webhook(server: WebServer, feed: Callable[[Dict[str, Any]], Awaitable[None]]):
+    """Принимать апдейты через вебхук до SIGTERM/SIGINT.
+
+    Вебхук при остановке не удаляем: пока бот перезапускается, Telegram
+    копит апдейты. Без WEBHOOK_SECRET секрет генерируется при запуске и
+    передаётся Telegram в set_webhook - вебхук без проверки не принимаем.
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL is required in webhook mode")
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server.enable_webhook(feed, secret, WEBHOOK_PATH)
+    await server.start()
+
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
     )
+    logger.info(f"Bot started webhook on {WEBHOOK_URL}{WEBHOOK_PATH}")
+    await wait_for_stop_signal()
+    server.close_intake()
 
-# ==================== ЗАПУСК ====================
 
 async def main():
     """Главная функция"""
     # Инициализация БД
     await db.init_db()
     logger.info("Database initialized")
+    await metadata.start()
+
+    # Запуск записи FSM-сессий и реестра пользователей
+    await storage.start()
+    await user_registry.start()
+
+    # Запуск планировщика отложенных постов, очереди публикаций и проверок файлов и каналов
+    await scheduler.start()
+    await outbox.start()
+    await media_registry.start()
+    await channel_monitor.start()
 
-    # Запуск keep-alive
-    keep_alive()
-    logger.info("Keep-alive started")
+    # Продолжение прерванных рассылок
+    await broadcaster.resume()
 
     # Регистрация роутера
     dp.include_router(router)
 
-    # Удаление вебхука
+    # Запуск бота
+    server = WebServer()
+    metrics_server = WebServer(METRICS_HOST, METRICS_PORT)
+    metrics_server.enable_metrics()
+    await metrics_server.start()
+    try:
+        if RUN_MODE == "webhook":
+            feeder = UpdateFeeder()
+            await dp.emit_startup(bot=bot)
+            try:
+                await run_webhook(server, feeder.feed)
+            finally:
+                await feeder.drain()
+                await dp.emit_shutdown(bot=bot)
+        else:
+            await run_polling(server)
+    finally:
+        await server.stop()
+        await metrics_server.stop()
+        await broadcaster.stop()
+        await channel_monitor.stop()
+        await media_registry.stop()
+        await scheduler.stop()
+        await outbox.stop()
+        # Только после фоновых задач: отправка после close() открыла бы новую сессию, которую уже никто не закроет
+        await bot.session.close()
+        await user_registry.close()
+        await db.close()
+        logger.info("Database closed")
+
+# ==================== РЕЖИМ ВОРКЕРОВ ====================
+
+async def poll_updates(feed: Callable[[Dict[str, Any]], Awaitable[None]]):
+    """Long polling без обработки: сырые апдейты уходят в feed"""
     await bot.delete_webhook(drop_pending_updates=True)
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
     logger.info("Bot started polling")
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.error(f"Failed to get updates: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await feed(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+            offset = update.update_id + 1
+
+
+async def run_front(queues: List[Any]):
+    """Главный процесс: получает апдейты и раздаёт их воркерам"""
+    dp.include_router(router)  # Нужен для списка allowed_updates
+    updates = UpdateRouter(queues)
+    server = WebServer()
+    try:
+        if RUN_MODE == "webhook":
+            await run_webhook(server, updates.route)
+        else:
+            await server.start()
+            poller = asyncio.create_task(poll_updates(updates.route))
+            try:
+                await wait_for_stop_signal()
+            finally:
+                poller.cancel()
+                await asyncio.gather(poller, return_exceptions=True)
+    finally:
+        await server.stop()
+        await bot.session.close()
+
+
+async def worker_main(index: int, queue: Any):
+    """Воркер: обрабатывает свою долю апдейтов, фоновые задачи - если лидер"""
+    await db.open()
+    await metadata.start()
+    await storage.start()
+    await user_registry.start()
+    dp.include_router(router)
+    await dp.emit_startup(bot=bot)
+
+    feeder = UpdateFeeder()
+    election = LeaderElection(db)
+    await election.start()
+    # Метрики у каждого воркера свои: /metrics на METRICS_PORT + 1 + index
+    server = WebServer(METRICS_HOST, METRICS_PORT + 1 + index)
+    server.enable_metrics()
+    await server.start()
+    logger.info(f"Worker {index} started (pid {os.getpid()})")
+
+    loop = asyncio.get_running_loop()
+    try:
+        # None в очереди - сигнал остановки от главного процесса
+        while (update := await loop.run_in_executor(None, queue.get)) is not None:
+            await feeder.feed(update)
+    finally:
+        await server.stop()
+        await feeder.drain()
+        await election.stop()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        await user_registry.close()
+        await db.close()
+        logger.info(f"Worker {index} stopped")
+
+
+def run_worker(index: int, queue: Any):
+    # Сигналы получает главный процесс и останавливает воркеров через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(worker_main(index, queue))
+
+
+def run_cluster(workers: int = WORKERS):
+    """Несколько процессов-обработчиков за одним источником апдейтов"""
+    async def migrate():
+        await db.init_db()
+        await db.close()
+
+    # Миграции - один раз до запуска воркеров
+    asyncio.run(migrate())
+    logger.info("Database initialized")
 
-    # Запуск бота
-    await dp.start_polling(bot)
+    queues = [multiprocessing.Queue(maxsize=WEBHOOK_MAX_INFLIGHT) for _ in range(workers)]
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(index, queue), name=f"worker-{index}")
+        for index, queue in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        asyncio.run(run_front(queues))
+    finally:
+        for queue in queues:
+            try:
+                queue.put(None, timeout=SHUTDOWN_TIMEOUT)
+            except Exception:
+                pass  # Воркер не разбирает очередь, его остановит terminate()
+        for process in processes:
+            process.join(SHUTDOWN_TIMEOUT + LEADER_RENEW_INTERVAL)
+            if process.is_alive():
+                logger.warning(f"{process.name} did not stop in time, terminating")
+                process.terminate()
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if WORKERS > 1:
+            run_cluster()
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
 
         logger.info("Bot stopped")
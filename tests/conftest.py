@@ -0,0 +1,24 @@
+"""Общие фикстуры тестов.
+
+Модуль бота грузится так же, как в бенчмарках (benchmarks/common.py):
+файл ``python Malik.py`` не импортируется обычным ``import``. Асинхронный
+код тесты выполняют через asyncio.run, без плагинов pytest.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from common import load_bot  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def malik():
+    return load_bot()
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "malik_post.db")
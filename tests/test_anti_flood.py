@@ -0,0 +1,35 @@
+"""Лимиты AntiFloodMiddleware на нажатия кнопок."""
+from datetime import datetime
+
+from aiogram.types import CallbackQuery, Chat, Message, User
+
+
+def _callback(data: str, message_id: int = 1) -> CallbackQuery:
+    user = User(id=1, is_bot=False, first_name="u")
+    message = Message(message_id=message_id, date=datetime.now(), chat=Chat(id=1, type="private"), text="x")
+    return CallbackQuery(id="1", from_user=user, chat_instance="1", message=message, data=data)
+
+
+def test_rapid_channel_selection_is_not_throttled(malik):
+    flood = malik.AntiFloodMiddleware()
+    assert [flood.check(1, _callback(f"select_ch_{i}")) for i in range(20)] == [None] * 20
+
+
+def test_large_selection_leaves_room_for_other_buttons(malik):
+    flood = malik.AntiFloodMiddleware()
+    assert all(flood.check(1, _callback(f"select_ch_{i}")) is None for i in range(50))
+    assert flood.check(1, _callback("channels_done")) is None
+
+
+def test_selection_spam_is_still_limited(malik):
+    flood = malik.AntiFloodMiddleware()
+    results = [flood.check(1, _callback(f"select_ch_{i}")) for i in range(malik.FLOOD_SELECTION_BURST + 1)]
+    assert results[:-1] == [None] * malik.FLOOD_SELECTION_BURST
+    assert results[-1] == "callback"
+
+
+def test_other_buttons_keep_their_limit(malik):
+    flood = malik.AntiFloodMiddleware()
+    results = [flood.check(1, _callback(f"draft_{i}")) for i in range(malik.FLOOD_CALLBACK_BURST + 1)]
+    assert results[-1] == "callback"
+    assert flood.check(1, _callback("select_ch_1", message_id=2)) is None
@@ -0,0 +1,41 @@
+"""Метки метрик хендлеров не должны зависеть от произвольных данных клиента."""
+import asyncio
+from datetime import datetime
+
+from aiogram import Router
+from aiogram.types import CallbackQuery, Chat, Message, User
+
+
+def _callback(data: str) -> CallbackQuery:
+    user = User(id=1, is_bot=False, first_name="u")
+    message = Message(message_id=1, date=datetime.now(), chat=Chat(id=1, type="private"), text="x")
+    return CallbackQuery(id="1", from_user=user, chat_instance="1", message=message, data=data)
+
+
+def test_known_callbacks_keep_their_route(malik):
+    assert malik.callback_route("select_ch_12") == "select_ch"
+    assert malik.callback_route("drafts_after_1700000000-5") == "drafts_after"
+    assert malik.callback_route("delete_draft_3") == "delete_draft"
+    assert malik.callback_route("draft_3") == "draft"
+    assert malik.callback_route("drafts") == "drafts"
+    assert malik.callback_route("main_menu") == "main_menu"
+
+
+def test_forged_callback_data_keeps_route_labels_bounded(malik):
+    forged = [f"{prefix}{i}x" for i in range(200)
+              for prefix in ("draft_", "drafts_after_", "select_ch_", "", "main_menu_", "/start")]
+    forged += ["", "draft", "select_ch", "x" * 64]
+
+    async def handler(event, data):
+        return None
+
+    async def run():
+        middleware = malik.HandlerMetricsMiddleware(Router())
+        for data in forged:
+            await middleware(handler, _callback(data), {})
+
+    asyncio.run(run())
+    routes = {key[1] for key in malik.HANDLER_LATENCY._values if key[0] == "unknown"}
+    allowed = set(malik.CALLBACK_ROUTES) | {p[:-1] for p in malik.CALLBACK_PREFIXES} | {"other"}
+    assert routes <= allowed
+    assert routes == {"draft", "drafts_after", "select_ch", "other"}
@@ -0,0 +1,26 @@
+"""Восстановление отложенных постов после перезапуска"""
+import asyncio
+from datetime import datetime, timedelta
+
+
+def test_restart_returns_sending_posts_to_pending(malik, db_path):
+    async def scenario():
+        db = malik.Database(db_path)
+        await db.init_db()
+        try:
+            post_id = await db.add_scheduled_post(
+                1, -100, "Пост", "[]", "[]", datetime.now() + timedelta(hours=1))
+            # Процесс упал после claim, но до записи в outbox
+            assert [post["id"] for post in await db.claim_scheduled_posts([post_id])] == [post_id]
+
+            scheduler = malik.PostScheduler(db)
+            await scheduler.start()
+            queued = [queued_id for _, queued_id in scheduler._heap]
+            await scheduler.stop()
+            return post_id, queued, await db.get_pending_schedule()
+        finally:
+            await db.close()
+
+    post_id, queued, pending = asyncio.run(scenario())
+    assert queued == [post_id]
+    assert [pending_id for pending_id, _ in pending] == [post_id]